@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+from typing import Callable, List, Optional
+
+import asyncpg
+
+from .config import settings
+from .database import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+
+# Channel the Postgres broker publishes on. Any process (another worker, another
+# node, or a different service) can push to the notification sockets with
+# SELECT pg_notify('notification_events', '{"user_id": 1, "data": {...}}')
+EVENTS_CHANNEL = "notification_events"
+
+# Postgres refuses NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 8000
+
+
+class InMemoryBroker:
+    """
+    Hands every published event straight back to this process.
+
+    Enough for a single worker, and for tests.
+    """
+
+    def __init__(self):
+        self.handlers: List[Callable[[dict], None]] = []
+
+    def subscribe(self, handler: Callable[[dict], None]):
+        self.handlers.append(handler)
+
+    def deliver(self, event: dict):
+        for handler in self.handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                logger.error(f"Error handling notification event: {e}", exc_info=True)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: dict):
+        self.deliver(event)
+
+
+class PostgresBroker(InMemoryBroker):
+    """
+    Fans events out to every worker and node through Postgres NOTIFY.
+
+    Each process LISTENs on ``EVENTS_CHANNEL`` and only delivers to the sockets it
+    holds itself, so the notification service scales out without sticky routing.
+    Payloads are JSON and limited by Postgres to 8000 bytes. asyncpg runs one
+    operation at a time per connection, so publishes on the LISTEN connection
+    take turns.
+    """
+
+    def __init__(self, dsn: str = DATABASE_URL, channel: str = EVENTS_CHANNEL):
+        super().__init__()
+        self.dsn = dsn
+        self.channel = channel
+        self.connection: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._publish_lock = asyncio.Lock()
+
+    async def start(self):
+        self._closing = False
+        self.connection = await asyncpg.connect(self.dsn)
+        await self.connection.add_listener(self.channel, self._on_notification)
+        self.connection.add_termination_listener(self._on_termination)
+        logger.info("Notification broker started")
+
+    async def stop(self):
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self.connection and not self.connection.is_closed():
+            await self.connection.close()
+        self.connection = None
+        logger.info("Notification broker stopped")
+
+    async def publish(self, event: dict):
+        """
+        Publish an event to every process, this one included. While the broker is
+        disconnected the event is only delivered locally.
+        """
+        payload = json.dumps(event, separators=(",", ":"))
+        if self.connection is None or self.connection.is_closed():
+            logger.error("Notification broker is disconnected, delivering event locally only")
+            await super().publish(event)
+            return
+        try:
+            async with self._publish_lock:
+                await self.connection.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+        except Exception as e:
+            logger.error(f"Error publishing notification event: {e}")
+            await super().publish(event)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.error(f"Unexpected payload on {channel}: {payload!r}")
+            return
+        if isinstance(event, dict):
+            self.deliver(event)
+
+    def _on_termination(self, connection):
+        if self._closing:
+            return
+        logger.error("Notification broker connection lost, reconnecting")
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while not self._closing:
+            await asyncio.sleep(settings.notification_listener_retry)
+            try:
+                await self.start()
+                return
+            except Exception as e:
+                logger.error(f"Notification broker reconnect failed: {e}")
+
+
+BROKERS = {
+    "postgres": PostgresBroker,
+    "memory": InMemoryBroker,
+}
+
+
+def create_broker(name: str = None):
+    """
+    Build the broker named by ``notification_broker`` ("postgres" or "memory").
+    """
+    name = name or settings.notification_broker
+    try:
+        return BROKERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown notification broker: {name!r}")
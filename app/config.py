@@ -12,8 +12,64 @@ class Settings(BaseSettings):
     secret_key: str
     algorithm: str
     access_token_expire_minutes: int
+    password_hash_workers: int = 4
+    password_hash_concurrency: int = 16
+    auth_cache_size: int = 10000
+    auth_cache_ttl: float = 60.0
+    invitation_cache_size: int = 10000
+    invitation_cache_ttl: float = 300.0
     key_crypto: str
+    crypto_executor: str = "thread"
+    crypto_workers: int = 2
+    crypto_offload_threshold: int = 65536
     openai_api_key: str
+    database_pool_size: int = 20
+    database_max_overflow: int = 50
+    database_pool_recycle: int = 3600
+    database_pool_timeout: float = 30
+    database_connect_retries: int = 10
+    database_connect_backoff: float = 0.5
+    database_connect_backoff_max: float = 10.0
+    database_pool_warmup: int = 0
+    notification_broker: str = "postgres"
+    notification_install_triggers: bool = True
+    notification_listener_retry: float = 2.0
+    rooms_state_interval: float = 60.0
+    notification_batch_interval: float = 0.2
+    notification_batch_size: int = 5000
+    notification_reconcile_interval: float = 60.0
+    notification_heartbeat_interval: float = 25.0
+    notification_idle_timeout: float = 0
+    loop_lag_interval: float = 0.5
+    metrics_sample_interval: float = 5.0
+    log_level: str = "INFO"
+    log_file: str = "_log/app.log"
+    log_json: bool = True
+    log_rate_limit: int = 50
+    presence_flush_interval: float = 1.0
+    presence_track_online_time: bool = False
+    presence_rollup_interval: float = 300.0
+    presence_touch_interval: float = 60.0
+    presence_sync_interval: float = 30.0
+    presence_room_counts_ttl: float = 2.0
+    notification_outbox_size: int = 100
+    notification_max_lag: float = 30.0
+    notification_compress_threshold: int = 1024
+    notification_compress_level: int = 6
+    notification_max_unread: int = 100
+    notification_max_invitations: int = 100
+    notification_max_sockets: int = 10000
+    notification_event_log_size: int = 200
+    notification_event_log_ttl: float = 300.0
+    notification_event_log_users: int = 10000
+    notification_connect_rate_ip: float = 5.0
+    notification_connect_burst_ip: int = 20
+    notification_connect_rate_user: float = 1.0
+    notification_connect_burst_user: int = 10
+    notification_message_rate_ip: float = 20.0
+    notification_message_burst_ip: int = 100
+    notification_message_rate_user: float = 2.0
+    notification_message_burst_user: int = 20
 
     model_config = SettingsConfigDict(env_file = ".env")
 
@@ -1,36 +1,371 @@
+import asyncio
+import itertools
 import logging
+import time
+import zlib
+from collections import OrderedDict
+import msgpack
 from fastapi import WebSocket
-from typing import Dict, List, Tuple
+from pydantic_core import to_json, to_jsonable_python
+from starlette.websockets import WebSocketState
+from typing import Any, Dict, Optional, Set, Tuple
+from .broker import InMemoryBroker
+from .config import settings
+from .metrics import FRAMES_COALESCED, FRAMES_DROPPED, NOTIFICATIONS_SENT, SLOW_CONSUMERS_EVICTED
 # from routers.func_notification import update_user_status
 
 
-logging.basicConfig(filename='_log/connect.log', format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Wire encodings a client can ask for with ?encoding=
+ENCODINGS = ("json", "msgpack")
+
+
+def serialize(data) -> str:
+    """
+    Encode a frame the way ``WebSocket.send_json`` does (compact JSON), so it can be
+    built once and sent as text to any number of sockets. pydantic_core's encoder
+    is several times faster than the json module and also takes the models from
+    app.schemas as they are.
+    """
+    return to_json(data).decode("utf-8")
+
+
+def pack(data) -> bytes:
+    """
+    Encode a frame as MessagePack, for the sockets that negotiated it.
+    """
+    return msgpack.packb(to_jsonable_python(data))
+
+
+class Frame:
+    """
+    A frame, encoded (and compressed) at most once per wire encoding however many
+    sockets it goes to. Frames with the same ``key`` coalesce while they wait in an
+    outbox, ``data`` is kept for the ones that are merged rather than replaced.
+    """
+    __slots__ = ("key", "data", "_text", "_packed", "_deflated")
+
+    def __init__(self, text: Optional[str] = None, key: Optional[str] = None, data: Any = None,
+                 packed: Optional[bytes] = None):
+        self.key = key
+        self.data = data
+        self._text = text
+        self._packed = packed
+        self._deflated: Dict[bool, bytes] = {}
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = serialize(self.data)
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = pack(self.data)
+        return self._packed
+
+    def size(self, binary: bool) -> int:
+        return len(self.packed) if binary else len(self.text)
+
+    def deflated(self, binary: bool) -> bytes:
+        """
+        The zlib-compressed MessagePack (``binary``) or JSON encoding of the frame.
+        """
+        if binary not in self._deflated:
+            payload = self.packed if binary else self.text.encode("utf-8")
+            self._deflated[binary] = zlib.compress(payload, settings.notification_compress_level)
+        return self._deflated[binary]
+
+
+def make_frame(data, key: Optional[str] = None) -> Frame:
+    return Frame(key=key, data=data)
+
+
+def merge_frames(old: Frame, new: Frame) -> Frame:
+    """
+    Coalesce two queued frames with the same key. Message deltas are merged, any
+    other frame is superseded by the newer one.
+    """
+    if not (isinstance(old.data, dict) and isinstance(new.data, dict)
+            and "new_message_delta" in old.data and "new_message_delta" in new.data):
+        return new
+    old_delta, new_delta = old.data["new_message_delta"], new.data["new_message_delta"]
+    read = set(old_delta["read"]) | set(new_delta["read"])
+    added = [msg for msg in old_delta["added"] + new_delta["added"] if msg["message_id"] not in read]
+    return make_frame(dict(new.data, new_message_delta=dict(new_delta, added=added, read=sorted(read))), new.key)
+
+
+HEARTBEAT = make_frame({"heartbeat": True})
+
+
+class SlowConsumerError(Exception):
+    """
+    Raised for a socket whose outbox stayed behind for too long.
+    """
+
+
+class Outbox:
+    """
+    Bounded queue of the frames waiting for one socket's writer task.
+
+    A keyed frame replaces the queued frame with the same key (keeping its place),
+    so bursts of "room update" or message frames cost one slot. The outbox is
+    marked evicted once it is full, or once its oldest frame has waited longer than
+    ``max_lag`` seconds.
+    """
+
+    def __init__(self, maxsize: int, max_lag: float):
+        self.maxsize = maxsize
+        self.max_lag = max_lag
+        self.frames: "OrderedDict[Any, Tuple[float, Frame]]" = OrderedDict()
+        self.evicted = asyncio.Event()
+        self._ready = asyncio.Event()
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame: Frame) -> str:
+        """
+        Returns "queued", "coalesced" or "dropped".
+        """
+        if self.evicted.is_set():
+            return "dropped"
+        now = time.monotonic()
+        if self.frames:
+            oldest, _ = next(iter(self.frames.values()))
+            if self.max_lag and now - oldest > self.max_lag:
+                self.evicted.set()
+                return "dropped"
+        if frame.key is not None and frame.key in self.frames:
+            queued_at, old = self.frames[frame.key]
+            self.frames[frame.key] = (queued_at, merge_frames(old, frame))
+            return "coalesced"
+        if len(self.frames) >= self.maxsize:
+            self.evicted.set()
+            return "dropped"
+        key = frame.key if frame.key is not None else next(self._counter)
+        self.frames[key] = (now, frame)
+        self._ready.set()
+        return "queued"
+
+    async def get(self) -> Frame:
+        while not self.frames:
+            self._ready.clear()
+            await self._ready.wait()
+        _, (_, frame) = self.frames.popitem(last=False)
+        return frame
+
+
 class ConnectionManagerNotification:
-    def __init__(self):
-        # List to store active WebSocket connections
-        self.active_connections: List[WebSocket] = []
-        self.user_connections: Dict[int, Tuple[WebSocket]] = {}
+    def __init__(self, broker=None):
+        # Every open socket, and the open sockets of each user (one per device/tab)
+        self.active_connections: Set[WebSocket] = set()
+        self.user_connections: Dict[int, Set[WebSocket]] = {}
+        # Frames waiting for the writer task of each socket
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+        # Sockets that negotiated MessagePack, the others get JSON text frames, and
+        # sockets that asked for large frames to be compressed
+        self.binary_sockets: Set[WebSocket] = set()
+        self.compressed_sockets: Set[WebSocket] = set()
+        self.frames_coalesced = 0
+        self.frames_dropped = 0
+        self.slow_consumers_evicted = 0
+        # User ids with a pending change, per change kind ("messages", "invitations",
+        # "password"), and the kinds that concern every connected user ("rooms", or
+        # all of them after the listener reconnects)
+        self.pending_changes: Dict[str, Set[int]] = {}
+        self.pending_broadcasts: Set[str] = set()
+        self.changes_event = asyncio.Event()
+        # Events published on any worker come back through the broker, and are
+        # delivered to the sockets of this process only
+        self.broker = broker or InMemoryBroker()
+        self.broker.subscribe(self._on_event)
 
-    async def connect(self, websocket: WebSocket, user_id: int):
+    async def connect(self, websocket: WebSocket, user_id: int, encoding: str = "json", compress: bool = False):
         """
         Accepts a new WebSocket connection and stores it in the list of active connections
-        and the dictionary of user connections.
+        and the dictionary of user connections. ``encoding`` is "json" or "msgpack",
+        with ``compress`` frames of at least ``notification_compress_threshold``
+        bytes are sent zlib-compressed as binary frames.
         """
         await websocket.accept()
-        print("Connect")
+        if encoding == "msgpack":
+            self.binary_sockets.add(websocket)
+        if compress:
+            self.compressed_sockets.add(websocket)
+        logger.debug(f"WebSocket connected for user {user_id}")
         # await update_user_status(session, user_id, is_online=bool)
-        self.active_connections.append(websocket)
-        self.user_connections[user_id] = (websocket,)
+        self.active_connections.add(websocket)
+        self.user_connections.setdefault(user_id, set()).add(websocket)
+        self.outboxes[websocket] = Outbox(settings.notification_outbox_size, settings.notification_max_lag)
 
-    async def disconnect(self, websocket: WebSocket, user_id):
+    async def disconnect(self, websocket: WebSocket, user_id, code: int = 1000):
         """
         Removes a WebSocket connection from the list of active connections and the user
-        connections dictionary when a user disconnects.
+        connections dictionary when a user disconnects, closing it with ``code`` if
+        it is still open.
         """
-        print("Disconnecting")
-        await websocket.close()
-        self.active_connections.remove(websocket)
-        self.user_connections.pop(user_id, None)
+        logger.debug(f"WebSocket disconnecting for user {user_id}")
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close(code=code)
+        self.active_connections.discard(websocket)
+        self.binary_sockets.discard(websocket)
+        self.compressed_sockets.discard(websocket)
+        self.outboxes.pop(websocket, None)
+        sockets = self.user_connections.get(user_id)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.user_connections[user_id]
+
+    def is_connected(self, user_id: int) -> bool:
+        return user_id in self.user_connections
 
+    def sockets(self, user_id: int) -> Set[WebSocket]:
+        return self.user_connections.get(user_id, set())
+
+    def send_user(self, user_id: int, data, key: Optional[str] = None):
+        """
+        Queues one event for every socket of a user, encoded only once.
+        """
+        frame = make_frame(data, key)
+        for websocket in list(self.sockets(user_id)):
+            self.send_frame(websocket, frame)
+
+    def send_all(self, data, key: Optional[str] = None):
+        """
+        Queues one event for every socket of this process, encoded only once.
+        """
+        frame = make_frame(data, key)
+        for websocket in list(self.active_connections):
+            self.send_frame(websocket, frame)
+
+    def send_frame(self, websocket: WebSocket, frame: Frame):
+        """
+        Queues a frame for the writer task of the socket. Never blocks, frames for
+        a socket that is already gone are dropped, and a socket that can't keep up
+        is evicted.
+        """
+        outbox = self.outboxes.get(websocket)
+        if outbox is None:
+            return
+        evicted = outbox.evicted.is_set()
+        result = outbox.put(frame)
+        # A coalesced frame goes out as part of the one already counted
+        if result == "queued":
+            NOTIFICATIONS_SENT.labels(frame.key or "other").inc()
+        elif result == "coalesced":
+            self.frames_coalesced += 1
+            FRAMES_COALESCED.inc()
+        else:
+            self.frames_dropped += 1
+            FRAMES_DROPPED.inc()
+            if not evicted:
+                self.slow_consumers_evicted += 1
+                SLOW_CONSUMERS_EVICTED.inc()
+                logger.warning(f"Evicting slow notification consumer ({len(outbox)} frames queued)")
+
+    def queue_depths(self) -> Tuple[int, int]:
+        """
+        Returns the total and the largest number of frames queued across sockets.
+        """
+        depths = [len(outbox) for outbox in self.outboxes.values()]
+        return sum(depths), max(depths, default=0)
+
+    async def wait_evicted(self, websocket: WebSocket):
+        """
+        Raises SlowConsumerError once the socket was evicted for staying behind.
+        """
+        outbox = self.outboxes.get(websocket)
+        if outbox is None:
+            return
+        await outbox.evicted.wait()
+        raise SlowConsumerError()
+
+    async def run_writer(self, websocket: WebSocket):
+        """
+        Writer task of a socket: pushes queued frames as they arrive, and a heartbeat
+        after ``notification_heartbeat_interval`` seconds without any, so clients
+        don't have to send keep-alive text. Returns when the socket is disconnected,
+        a failed send is raised.
+
+        Compressed frames always go out binary. A zlib stream starts with 0x78, which
+        no MessagePack map does, so MessagePack clients can tell them apart.
+        """
+        timeout = settings.notification_heartbeat_interval or None
+        binary = websocket in self.binary_sockets
+        compress = websocket in self.compressed_sockets
+        threshold = settings.notification_compress_threshold
+        while True:
+            outbox = self.outboxes.get(websocket)
+            if outbox is None:
+                return
+            try:
+                frame = await asyncio.wait_for(outbox.get(), timeout)
+            except asyncio.TimeoutError:
+                frame = HEARTBEAT
+            if compress and frame.size(binary) >= threshold:
+                await websocket.send_bytes(frame.deflated(binary))
+            elif binary:
+                await websocket.send_bytes(frame.packed)
+            else:
+                await websocket.send_text(frame.text)
+
+    def notify_user(self, user_id: int, kind: str):
+        """
+        Flags a change of the given kind for a user connected to this process.
+        """
+        if user_id not in self.user_connections:
+            return
+        self.pending_changes.setdefault(kind, set()).add(user_id)
+        self.changes_event.set()
+
+    def notify_all(self, kind: str):
+        """
+        Flags a change of the given kind for every connected user.
+        """
+        self.pending_broadcasts.add(kind)
+        self.changes_event.set()
+
+    async def publish(self, data=None, user_id: Optional[int] = None, kind: Optional[str] = None):
+        """
+        Publishes an event to every worker and node. ``data`` is sent as is to the
+        sockets of ``user_id`` (or to every socket), ``kind`` flags a change for the
+        scheduler to re-check, like a NOTIFY from the database triggers would.
+        """
+        event = {"user_id": user_id}
+        if data is not None:
+            event["data"] = data
+        if kind is not None:
+            event["kind"] = kind
+        await self.broker.publish(event)
+
+    def _on_event(self, event: dict):
+        user_id = event.get("user_id")
+        if user_id is not None and not self.is_connected(user_id):
+            return
+        kind = event.get("kind")
+        if kind is not None:
+            if user_id is None:
+                self.notify_all(kind)
+            else:
+                self.notify_user(user_id, kind)
+        if "data" in event:
+            if user_id is None:
+                self.send_all(event["data"])
+            else:
+                self.send_user(user_id, event["data"])
+
+    async def wait_for_changes(self) -> Tuple[Dict[str, Set[int]], Set[str]]:
+        """
+        Waits until at least one change was flagged and returns the pending changes
+        and broadcasts, clearing them.
+        """
+        await self.changes_event.wait()
+        self.changes_event.clear()
+        changes, self.pending_changes = self.pending_changes, {}
+        broadcasts, self.pending_broadcasts = self.pending_broadcasts, set()
+        return changes, broadcasts
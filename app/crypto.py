@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Ініціалізація шифрувальника
+key = settings.key_crypto
+cipher = Fernet(key)
+
+# Stored messages are base64(Fernet token) and every Fernet token starts with the
+# version byte 0x80, i.e. "gAAAAA" once encoded, so base64 of that is a fixed
+# prefix. Checking it replaces a full decode/encode round trip.
+ENCRYPTED_PREFIX = base64.b64encode(b"gAAAAA").decode("utf-8")
+
+_executor: Optional[Executor] = None
+
+
+def is_base64(s):
+    try:
+        return base64.b64encode(base64.b64decode(s)).decode('utf-8') == s
+    except Exception:
+        return False
+
+
+def is_encrypted(s: str) -> bool:
+    return s.startswith(ENCRYPTED_PREFIX)
+
+
+def encrypt(data: Optional[str]):
+    if data is None:
+        return None
+
+    encrypted = cipher.encrypt(data.encode())
+    return base64.b64encode(encrypted).decode('utf-8')
+
+
+def decrypt(encoded_data: Optional[str]):
+    if encoded_data is None:
+        return None
+
+    if not is_encrypted(encoded_data):
+        return encoded_data
+
+    try:
+        encrypted = base64.b64decode(encoded_data.encode('utf-8'))
+        return cipher.decrypt(encrypted).decode('utf-8')
+    except (InvalidToken, ValueError):
+        return None
+
+
+def encrypt_many(values: Iterable[Optional[str]]) -> List[Optional[str]]:
+    return [encrypt(value) for value in values]
+
+
+def decrypt_many(values: Iterable[Optional[str]]) -> List[Optional[str]]:
+    return [decrypt(value) for value in values]
+
+
+def get_executor() -> Optional[Executor]:
+    """
+    The pool bulk calls above ``crypto_offload_threshold`` run in, per
+    ``crypto_executor`` ("thread", "process" or "none").
+    """
+    global _executor
+    if _executor is None and settings.crypto_executor != "none":
+        if settings.crypto_executor == "process":
+            _executor = ProcessPoolExecutor(max_workers=settings.crypto_workers)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=settings.crypto_workers, thread_name_prefix="crypto")
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def _run(func, values: List[Optional[str]]) -> List[Optional[str]]:
+    size = sum(len(value) for value in values if value is not None)
+    executor = get_executor() if size >= settings.crypto_offload_threshold else None
+    if executor is None:
+        return func(values)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, values)
+
+
+async def async_encrypt_many(values: Iterable[Optional[str]]) -> List[Optional[str]]:
+    """
+    Encrypt a batch of messages in one call. Batches of at least
+    ``crypto_offload_threshold`` characters are encrypted off the event loop.
+    """
+    return await _run(encrypt_many, list(values))
+
+
+async def async_decrypt_many(values: Iterable[Optional[str]]) -> List[Optional[str]]:
+    """
+    Decrypt a batch of messages in one call. Values that are not encrypted are
+    returned as they are, values that fail to decrypt as None.
+    """
+    return await _run(decrypt_many, list(values))
+
+
+async def async_encrypt(data: Optional[str]):
+    return (await async_encrypt_many([data]))[0]
+
+
+async def async_decrypt(encoded_data: Optional[str]):
+    return (await async_decrypt_many([encoded_data]))[0]
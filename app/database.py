@@ -1,11 +1,16 @@
+import asyncio
+import logging
 import time
 # from sqlalchemy import create_engine
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from typing import AsyncGenerator
 from .config import settings
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from .metrics import POOL_CHECKOUT_WAIT
+
+logger = logging.getLogger(__name__)
 
 
 Base = declarative_base()
@@ -13,12 +18,29 @@ Base = declarative_base()
         
 ASINC_SQLALCHEMY_DATABASE_URL = f'postgresql+asyncpg://{settings.database_name}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_username}'
 
+# Plain asyncpg DSN, used by the LISTEN connection in app.listener
+DATABASE_URL = f'postgresql://{settings.database_name}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_username}'
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    The default asyncpg pool, recording how long each checkout waits.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
 engine_asinc = create_async_engine(ASINC_SQLALCHEMY_DATABASE_URL,
-                                   pool_size=20,
-                                   max_overflow=50,
-                                   pool_recycle=3600,
+                                   poolclass=TimedQueuePool,
+                                   pool_size=settings.database_pool_size,
+                                   max_overflow=settings.database_max_overflow,
+                                   pool_recycle=settings.database_pool_recycle,
                                    pool_pre_ping=True,
-                                   pool_timeout=30,
+                                   pool_timeout=settings.database_pool_timeout,
                                    )
 async_session_maker = sessionmaker(engine_asinc, class_=AsyncSession, expire_on_commit=False)
 
@@ -28,15 +50,35 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
-while True:   
-    try:
-        conn = psycopg2.connect(host=settings.database_hostname, database=settings.database_name, user=settings.database_username,
-                                password=settings.database_password, cursor_factory=RealDictCursor)
-        cursor = conn.cursor()
-        print("Database connection was successful")
-        break
+async def connect_db():
+    """
+    Open the async pool at startup, retrying with exponential backoff.
+
+    Gives up after ``database_connect_retries`` attempts so a worker fails fast
+    instead of hanging when the database is down. With ``database_pool_warmup``
+    set, that many connections are opened up front so the first sockets don't
+    pay for the handshake.
+    """
+    delay = settings.database_connect_backoff
+    for attempt in range(1, settings.database_connect_retries + 1):
+        try:
+            async with engine_asinc.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            break
+        except Exception as error:
+            logger.error(f"Connection to database failed (attempt {attempt}): {error}")
+            if attempt == settings.database_connect_retries:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.database_connect_backoff_max)
+    logger.info("Database connection was successful")
+
+    warmup = min(settings.database_pool_warmup, engine_asinc.pool.size())
+    if warmup > 0:
+        connections = [await engine_asinc.connect() for _ in range(warmup)]
+        for conn in connections:
+            await conn.close()
+
 
-    except Exception as error:
-            print('Conection to database failed')
-            print("Error:",  error)
-            time.sleep(2)
\ No newline at end of file
+async def close_db():
+    await engine_asinc.dispose()
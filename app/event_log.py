@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from .connection_manager import Frame, make_frame, merge_frames
+
+
+# Frames that carry the whole current state: a newer one makes the older useless
+REPLACING_KEYS = {"invitations", "summary", "logout"}
+
+# Sequence numbers are epoch << 32 | counter, which stays below 2**53 for JS clients
+EPOCH_BITS = 20
+
+
+class EventLog:
+    """
+    Append-only log of the notification events sent to each user, so a client
+    reconnecting with ``?since=<seq>`` only gets what it missed.
+
+    Sequence numbers grow monotonically across the users of this process. Their
+    high bits hold a random epoch per process, so a cursor handed out by another
+    worker or before a restart is recognised, and answered with a full resync
+    rather than wrong deltas. Each user keeps at most ``size`` events for ``ttl``
+    seconds. Events carrying a whole state (invitations, summary, logout) replace
+    the previous one of their kind, message deltas are merged on replay.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.epoch = random.getrandbits(EPOCH_BITS) + 1
+        self.last_seq = self.epoch << 32
+        self._counter = itertools.count(self.last_seq + 1)
+        # Per user: (seq, logged at, frame key, frame data)
+        self.events: Dict[int, Deque[Tuple[int, float, str, Any]]] = {}
+        # Per user, the newest event dropped because the log was full, and for
+        # everyone the newest event dropped for its age: cursors below them missed it
+        self.floors: Dict[int, int] = {}
+        self.expired_seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._compact_periodically())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def append(self, user_ids: Iterable[int], key: str, data) -> int:
+        """
+        Logs one event for the given users and returns its sequence number.
+        """
+        seq = self.last_seq = next(self._counter)
+        if self.size <= 0:
+            return seq
+        now = time.monotonic()
+        for user_id in user_ids:
+            events = self.events.get(user_id)
+            if events is None:
+                events = self.events[user_id] = deque()
+            elif key in REPLACING_KEYS:
+                for event in list(events):
+                    if event[2] == key:
+                        events.remove(event)
+            events.append((seq, now, key, data))
+            while len(events) > self.size:
+                self.floors[user_id] = events.popleft()[0]
+        return seq
+
+    def cursor(self, user_id: int) -> int:
+        """
+        The seq a client of the user is up to date with once it has the current state.
+        """
+        events = self.events.get(user_id)
+        return events[-1][0] if events else self.last_seq
+
+    def since(self, user_id: int, seq: int) -> Optional[List[Frame]]:
+        """
+        The events of a user after ``seq``, one frame per key, or None when the
+        cursor is unknown here or older than what the log retains.
+        """
+        if seq >> 32 != self.epoch or seq > self.last_seq:
+            return None
+        if seq < max(self.floors.get(user_id, 0), self.expired_seq):
+            return None
+        frames: Dict[str, Frame] = {}
+        for event_seq, _, key, data in self.events.get(user_id, ()):
+            if event_seq <= seq:
+                continue
+            frame = make_frame(dict(data, seq=event_seq), key)
+            frames[key] = merge_frames(frames[key], frame) if key in frames else frame
+        return list(frames.values())
+
+    def compact(self):
+        """
+        Drops the events older than ``ttl`` and the users left without any.
+        """
+        expired = time.monotonic() - self.ttl
+        for user_id, events in list(self.events.items()):
+            while events and events[0][1] < expired:
+                self.expired_seq = max(self.expired_seq, events.popleft()[0])
+            if not events:
+                del self.events[user_id]
+                self.floors.pop(user_id, None)
+
+    async def _compact_periodically(self):
+        while True:
+            await asyncio.sleep(max(1.0, self.ttl / 10))
+            self.compact()
@@ -0,0 +1,36 @@
+"""
+One-off install of the triggers, tables and indexes the notification service
+relies on. Run it before deploying a version that changes them:
+
+    python -m app.install_schema
+
+Workers only create the NOTIFY triggers when one is missing, this replaces them
+all. It also creates and backfills unread_counters (message writes wait during
+the backfill, so run it off-peak), adds the online-time columns and tables, and
+builds the indexes concurrently. Workers run no DDL of their own besides the
+missing NOTIFY triggers.
+"""
+import asyncio
+import logging
+
+import asyncpg
+
+from .database import DATABASE_URL
+from .online_time import install_online_time_schema
+from .triggers import install_indexes, install_triggers, install_unread_counters
+
+
+async def main():
+    connection = await asyncpg.connect(DATABASE_URL)
+    try:
+        await install_triggers(connection)
+        await install_unread_counters(connection)
+        await install_indexes(connection)
+        await install_online_time_schema(connection)
+    finally:
+        await connection.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
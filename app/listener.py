@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from typing import Optional
+
+import asyncpg
+
+from . import oauth2
+from .config import settings
+from .routers.func_notification import invalidate_invitations
+from .database import DATABASE_URL
+from .triggers import CHANNEL_KINDS, install_triggers
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationListener:
+    """
+    One shared LISTEN connection per process.
+
+    Every NOTIFY raised by the triggers in ``app.triggers`` is turned into a change
+    signal for the sockets registered in ``ConnectionManagerNotification``, so the
+    sockets only touch the database when something they care about has changed.
+    """
+
+    def __init__(self, manager, rooms_state, dsn: str = DATABASE_URL):
+        self.manager = manager
+        self.rooms_state = rooms_state
+        self.dsn = dsn
+        self.connection: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self):
+        """
+        Open the LISTEN connection, install the triggers if any is missing and
+        subscribe to every channel.
+        """
+        self._closing = False
+        await self._connect(install=settings.notification_install_triggers)
+
+    async def _connect(self, install: bool = False):
+        self.connection = await asyncpg.connect(self.dsn)
+        if install:
+            await install_triggers(self.connection, replace=False)
+        for channel in CHANNEL_KINDS:
+            await self.connection.add_listener(channel, self._on_notification)
+        self.connection.add_termination_listener(self._on_termination)
+        logger.info("Notification listener started")
+
+    async def stop(self):
+        """
+        Close the LISTEN connection and stop any pending reconnect attempt.
+        """
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self.connection and not self.connection.is_closed():
+            await self.connection.close()
+        self.connection = None
+        logger.info("Notification listener stopped")
+
+    def _on_notification(self, connection, pid, channel, payload):
+        kind = CHANNEL_KINDS.get(channel)
+        if kind is None:
+            return
+        if kind == "rooms":
+            # Refreshed once per process, the sockets are told if the version moved.
+            # Cached invitations carry room names, drop them too.
+            invalidate_invitations()
+            self.rooms_state.schedule_refresh()
+            return
+        if not payload:
+            self.manager.notify_all(kind)
+            return
+        try:
+            user_id = int(payload)
+        except ValueError:
+            logger.error(f"Unexpected payload on {channel}: {payload!r}")
+            return
+        if kind == "auth":
+            oauth2.invalidate_user(user_id)
+            return
+        if kind == "invitations":
+            invalidate_invitations(user_id)
+        self.manager.notify_user(user_id, kind)
+
+    def _on_termination(self, connection):
+        if self._closing:
+            return
+        logger.error("Notification listener connection lost, reconnecting")
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while not self._closing:
+            await asyncio.sleep(settings.notification_listener_retry)
+            try:
+                # The triggers were checked at startup, no DDL on reconnect
+                await self._connect()
+            except Exception as e:
+                logger.error(f"Notification listener reconnect failed: {e}")
+                continue
+            # NOTIFYs sent while we were away are lost, make every socket re-check.
+            invalidate_invitations()
+            for kind in CHANNEL_KINDS.values():
+                if kind == "rooms":
+                    self.rooms_state.schedule_refresh()
+                elif kind == "auth":
+                    oauth2.clear_auth_cache()
+                else:
+                    self.manager.notify_all(kind)
+            return
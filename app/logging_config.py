@@ -0,0 +1,131 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from .config import settings
+
+
+PLAIN_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+# Attributes every LogRecord has, anything else came in through ``extra=``
+RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, the exception if any
+    and the fields passed with ``extra=``.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRS:
+                entry[name] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most ``limit`` records below WARNING per logger per second.
+    The first record let through after some were dropped carries their number
+    as ``suppressed``. Warnings and errors always pass.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        # logger name -> (window start, records let through, records dropped)
+        self.windows: Dict[str, Tuple[float, int, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0 or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        started, passed, dropped = self.windows.get(record.name, (now, 0, 0))
+        if now - started >= 1.0:
+            started, passed = now, 0
+        if passed >= self.limit:
+            self.windows[record.name] = (started, passed, dropped + 1)
+            return False
+        if dropped:
+            record.suppressed = dropped
+        self.windows[record.name] = (started, passed + 1, 0)
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread. Only the message and the traceback are
+    rendered on the caller's side, formatting and I/O happen in the writer.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def setup_logging():
+    """
+    Route every logger through one queue to a background writer, configured from
+    the ``log_*`` settings. Calling it again does nothing.
+
+    Returns:
+        None
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if settings.log_file:
+        os.makedirs(os.path.dirname(settings.log_file) or ".", exist_ok=True)
+        target = logging.FileHandler(settings.log_file, encoding="utf-8")
+    else:
+        target = logging.StreamHandler()
+    target.setFormatter(JsonFormatter() if settings.log_json else logging.Formatter(PLAIN_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    handler.addFilter(RateLimitFilter(settings.log_rate_limit))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(settings.log_level.upper())
+
+    _listener = logging.handlers.QueueListener(records, target, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Write out the queued records and stop the writer thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -1,12 +1,52 @@
-
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 # from .database import engine
-from .routers import notification
+from . import crypto, metrics
+from .config import settings
+from .database import connect_db, close_db, engine_asinc
+from .logging_config import setup_logging, stop_logging
+from .routers import auth, notification, presence
+from .routers import metrics as metrics_router
+
+gauges = metrics.register_gauges(notification.manager, notification.presence_index, engine_asinc)
+loop_lag = metrics.LoopLagMonitor(settings.loop_lag_interval)
 
 # models.Base.metadata.create_all(bind=engine)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    await loop_lag.start()
+    await connect_db()
+    await notification.manager.broker.start()
+    await notification.rooms_state.start()
+    await notification.scheduler.start()
+    await notification.listener.start()
+    await notification.presence.start()
+    await notification.presence_index.start()
+    await gauges.start()
+    if settings.presence_track_online_time:
+        await notification.online_time.start()
+    yield
+    await gauges.stop()
+    await notification.presence_index.stop()
+    await notification.presence.stop()
+    if settings.presence_track_online_time:
+        await notification.online_time.stop()
+    await notification.listener.stop()
+    await notification.scheduler.stop()
+    await notification.rooms_state.stop()
+    await notification.manager.broker.stop()
+    crypto.shutdown()
+    await close_db()
+    await loop_lag.stop()
+    stop_logging()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     docs_url="/docs",
     title="Notification API",
     description="Notification API",
@@ -25,4 +65,7 @@ app.add_middleware(
 
 
 
-app.include_router(notification.router)
\ No newline at end of file
+app.include_router(auth.router)
+app.include_router(notification.router)
+app.include_router(presence.router)
+app.include_router(metrics_router.router)
\ No newline at end of file
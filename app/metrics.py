@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import os
+import time
+from typing import Optional
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+from .config import settings
+
+# With several uvicorn workers behind one port, each scrape lands on a random
+# worker. Pointing PROMETHEUS_MULTIPROC_DIR at an empty directory makes every
+# worker write its metrics there and /metrics aggregate all of them.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+QUERY_LATENCY = Histogram(
+    "notification_query_seconds",
+    "Latency of the database helpers in app.routers.func_notification.",
+    ["function"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+NOTIFICATIONS_SENT = Counter(
+    "notifications_sent_total",
+    "Frames queued for notification sockets, per frame type. Frames coalesced into one already queued are not counted again.",
+    ["type"],
+)
+FRAMES_COALESCED = Counter(
+    "notification_frames_coalesced_total",
+    "Frames coalesced with one already queued in an outbox.",
+)
+FRAMES_DROPPED = Counter(
+    "notification_frames_dropped_total",
+    "Frames dropped by full or lagging outboxes.",
+)
+SLOW_CONSUMERS_EVICTED = Counter(
+    "notification_slow_consumers_evicted_total",
+    "Sockets evicted as slow consumers.",
+)
+CONNECTIONS_REJECTED = Counter(
+    "notification_connections_rejected_total",
+    "Notification sockets refused or closed by admission control, per reason.",
+    ["reason"],
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the engine_asinc pool.",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop wakes up a task sleeping for loop_lag_interval.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+def timed(func):
+    """
+    Record the latency of an async database helper in QUERY_LATENCY.
+    """
+    histogram = QUERY_LATENCY.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+# Sampled from the live objects of each worker, summed (or maxed) over the live
+# workers in multiprocess mode
+ACTIVE_CONNECTIONS = Gauge("notification_active_connections", "Open notification sockets.",
+                           multiprocess_mode="livesum")
+ACTIVE_USERS = Gauge("notification_active_users", "Users with at least one open socket, per worker summed.",
+                     multiprocess_mode="livesum")
+OUTBOX_FRAMES = Gauge("notification_outbox_frames", "Frames queued across all outboxes.",
+                      multiprocess_mode="livesum")
+OUTBOX_MAX_FRAMES = Gauge("notification_outbox_max_frames", "Frames queued in the fullest outbox.",
+                          multiprocess_mode="livemax")
+PRESENCE_ONLINE_USERS = Gauge("presence_online_users", "Users online on any worker or node.",
+                              multiprocess_mode="livemax")
+DB_POOL_SIZE = Gauge("db_pool_size", "Configured size of the engine_asinc pools.", multiprocess_mode="livesum")
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections currently checked out of the pools.",
+                            multiprocess_mode="livesum")
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "Connections open beyond the pool sizes.", multiprocess_mode="livesum")
+
+
+class NotificationGauges:
+    """
+    Sets the gauges from the live objects of this worker: sockets, users,
+    outboxes, presence and the connection pool. Sampled every
+    ``metrics_sample_interval`` seconds, so the other workers' values are fresh
+    in multiprocess mode, and again right before this worker answers a scrape.
+    """
+
+    def __init__(self, manager, presence_index, engine):
+        self.manager = manager
+        self.presence_index = presence_index
+        self.engine = engine
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.update()
+        if settings.metrics_sample_interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if MULTIPROCESS:
+            multiprocess.mark_process_dead(os.getpid())
+
+    def update(self):
+        manager = self.manager
+        total_depth, max_depth = manager.queue_depths()
+        ACTIVE_CONNECTIONS.set(len(manager.active_connections))
+        ACTIVE_USERS.set(len(manager.user_connections))
+        OUTBOX_FRAMES.set(total_depth)
+        OUTBOX_MAX_FRAMES.set(max_depth)
+        PRESENCE_ONLINE_USERS.set(len(self.presence_index.online_user_ids()))
+        pool = self.engine.pool
+        DB_POOL_SIZE.set(pool.size())
+        DB_POOL_CHECKED_OUT.set(pool.checkedout())
+        DB_POOL_OVERFLOW.set(max(0, pool.overflow()))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.metrics_sample_interval)
+            self.update()
+
+
+_gauges: Optional[NotificationGauges] = None
+
+
+def register_gauges(manager, presence_index, engine) -> NotificationGauges:
+    global _gauges
+    _gauges = NotificationGauges(manager, presence_index, engine)
+    return _gauges
+
+
+def render() -> bytes:
+    """
+    The metrics of this worker, or of every live worker in multiprocess mode.
+    """
+    if _gauges is not None:
+        _gauges.update()
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
+class LoopLagMonitor:
+    """
+    Samples event-loop lag into LOOP_LAG every ``interval`` seconds.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, loop.time() - started - self.interval))
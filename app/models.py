@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Interval, String, ForeignKey, Boolean, Enum
+from sqlalchemy import Column, Date, Index, Integer, Interval, String, ForeignKey, Boolean, Enum
 from sqlalchemy.sql.expression import text
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.orm import relationship
@@ -24,6 +24,21 @@ class PrivateMessage(Base):
     
     sender = relationship("User", foreign_keys=[sender_id])
 
+    # Covers the unread lookups of the notification scheduler (is_read is true
+    # for unread messages)
+    __table_args__ = (
+        Index('ix_private_messages_unread', 'receiver_id', 'id',
+              postgresql_where=text('is_read'), postgresql_include=['sender_id', 'fileUrl']),
+    )
+
+
+class UnreadCounter(Base):
+    __tablename__ = 'unread_counters'
+
+    receiver_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)
+    sender_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)
+    unread_count = Column(Integer, nullable=False, server_default='0')
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -78,6 +93,10 @@ class RoomInvitation(Base):
     room = relationship("Rooms", back_populates="invitations")
     sender = relationship("User", foreign_keys=[sender_id])
     recipient = relationship("User", foreign_keys=[recipient_id])
+
+    __table_args__ = (
+        Index('ix_room_invitations_pending', 'recipient_id', postgresql_where=text("status = 'pending'")),
+    )
     
     
     
@@ -88,4 +107,20 @@ class UserOnlineTime(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     session_start = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     session_end = Column(TIMESTAMP(timezone=True), nullable=True)
-    total_online_time = Column(Interval, nullable=False)
\ No newline at end of file
+    # Duration of this session once it is closed
+    total_online_time = Column(Interval, nullable=False)
+    # Last time the process that opened the session saw it still going
+    last_seen = Column(TIMESTAMP(timezone=True), nullable=True)
+    rolled_up = Column(Boolean, nullable=False, server_default='false')
+
+    __table_args__ = (
+        Index('ix_user_online_time_user_id_session_start', 'user_id', 'session_start'),
+    )
+
+
+class UserOnlineDaily(Base):
+    __tablename__ = 'user_online_daily'
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    online_time = Column(Interval, nullable=False)
\ No newline at end of file
@@ -1,9 +1,12 @@
 
+import time
+from typing import NamedTuple, Optional
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 
 from sqlalchemy import select
 from . import schemas, database, models
+from .utils import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -17,6 +20,31 @@ ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
 
+class AuthUser(NamedTuple):
+    """
+    The part of a user the notification sockets need to authorize a connect.
+    """
+    id: int
+    blocked: bool
+    password_changed: Optional[datetime]
+
+
+# Decoded tokens (token -> user id) and the users they point to (user id -> AuthUser).
+# User entries are dropped by the notification listener as soon as blocked or
+# password_changed changes, see invalidate_user.
+token_cache = TTLCache(settings.auth_cache_size, settings.auth_cache_ttl)
+user_cache = TTLCache(settings.auth_cache_size, settings.auth_cache_ttl)
+
+
+def invalidate_user(user_id: int):
+    user_cache.pop(user_id)
+
+
+def clear_auth_cache():
+    token_cache.clear()
+    user_cache.clear()
+
+
 def create_access_token(data: dict):
     """
     Generates a JWT access token.
@@ -61,6 +89,10 @@ def verify_access_token(token: str, credentials_exception):
 
     This function verifies the provided access token by decoding it using the JWT library. It extracts the user ID from the payload and returns it as a schemas.TokenData object. If the token cannot be verified, it raises an HTTPException with a status code of 401 (Unauthorized) and a custom error message.
     """
+    token_data = token_cache.get(token)
+    if token_data is not None:
+        return token_data
+
     try:
 
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -71,6 +103,12 @@ def verify_access_token(token: str, credentials_exception):
     except JWTError:
         raise credentials_exception
 
+    # Never serve a cached token past its own expiry
+    exp = payload.get("exp")
+    ttl = exp - time.time() if exp is not None else None
+    if ttl is None or ttl > 0:
+        token_cache.set(token, token_data, ttl)
+
     return token_data
     
 async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_session)):
@@ -82,12 +120,16 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
         db (AsyncSession): The database session to be used for querying the user data.
 
     Returns:
-        models.User: The current user object if the token is valid, otherwise None.
+        AuthUser: The id, blocked flag and password_changed of the current user, or None
+            if the user does not exist.
 
     Raises:
         HTTPException: If the token cannot be verified or the user does not exist in the database.
 
     This function retrieves the current user from the database based on the provided access token. It first verifies the access token by decoding it and extracting the user ID. Then, it queries the database using the user ID to retrieve the user object. If the token cannot be verified or the user does not exist in the database, it raises an HTTPException with a status code of 401 (Unauthorized) and a custom error message.
+
+    Decoded tokens and user records are cached for ``auth_cache_ttl`` seconds, so a
+    reconnect storm only reaches the database for users that are not cached yet.
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED, 
@@ -96,9 +138,20 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
         )
     
     token = verify_access_token(token, credentials_exception)
+
+    user = user_cache.get(token.id)
+    if user is not None:
+        return user
     
     async with db.begin() as session:
-        user = await db.execute(select(models.User).filter(models.User.id == token.id))
-        user = user.scalar()
-    
+        user = await db.execute(
+            select(models.User.id, models.User.blocked, models.User.password_changed)
+            .filter(models.User.id == token.id)
+        )
+        user = user.first()
+
+    if user is None:
+        return None
+    user = AuthUser(*user)
+    user_cache.set(user.id, user)
     return user
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from typing import Optional
+
+from sqlalchemy import text
+
+from .config import settings
+from .database import engine_asinc
+from .triggers import install_indexes
+
+logger = logging.getLogger(__name__)
+
+
+# Serialises concurrent installs and rollups when several workers run them at once.
+ONLINE_TIME_LOCK_ID = 7_310_002
+
+# user_online_time is append-only: one row per session, closed by a single UPDATE.
+# Daily totals live in user_online_daily and are rolled up in bulk.
+ONLINE_TIME_DDL = [
+    "ALTER TABLE user_online_time ADD COLUMN IF NOT EXISTS rolled_up boolean NOT NULL DEFAULT false",
+    "ALTER TABLE user_online_time ADD COLUMN IF NOT EXISTS last_seen timestamptz",
+    """
+    CREATE TABLE IF NOT EXISTS user_online_daily (
+        user_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        day date NOT NULL,
+        online_time interval NOT NULL,
+        PRIMARY KEY (user_id, day)
+    )
+    """,
+]
+
+# Built CONCURRENTLY by app.triggers.install_indexes
+ONLINE_TIME_INDEXES_DDL = {
+    "ix_user_online_time_user_id_session_start": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_online_time_user_id_session_start
+    ON user_online_time (user_id, session_start)
+    """,
+    # Keeps the rollup scan proportional to the sessions closed since the last one
+    "ix_user_online_time_pending_rollup": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_online_time_pending_rollup
+    ON user_online_time (id) WHERE NOT rolled_up
+    """,
+}
+
+# Closes the sessions nobody has touched for a while: the process that opened
+# them died. They end at the last time they were seen (rows from before
+# last_seen existed, at their start). Open sessions are never rolled up, so the
+# pending rollup index covers the scan.
+SWEEP_SQL = """
+UPDATE user_online_time
+SET session_end = COALESCE(last_seen, session_start),
+    total_online_time = COALESCE(last_seen, session_start) - session_start
+WHERE NOT rolled_up AND session_end IS NULL
+  AND COALESCE(last_seen, session_start) < now() - make_interval(secs => :grace)
+"""
+
+# Adds every session closed since the previous rollup to the daily totals, split
+# at UTC midnight, and marks it rolled up, in one statement. A user with sockets
+# on several workers has overlapping sessions: only the union of a user's
+# sessions counts, less what earlier rollups already counted, so a day never
+# adds up to more than 24h. Needs Postgres 14 for multiranges.
+ROLLUP_SQL = """
+WITH closed AS (
+    UPDATE user_online_time SET rolled_up = true
+    WHERE NOT rolled_up AND session_end IS NOT NULL
+    RETURNING user_id, session_start, session_end
+), batch AS (
+    SELECT user_id, range_agg(tstzrange(session_start, session_end)) AS online,
+           min(session_start) AS first_start, max(session_end) AS last_end
+    FROM closed
+    GROUP BY user_id
+), counted AS (
+    SELECT batch.user_id, batch.online - COALESCE((
+        SELECT range_agg(tstzrange(prior.session_start, prior.session_end))
+        FROM user_online_time prior
+        WHERE prior.user_id = batch.user_id AND prior.rolled_up
+          AND prior.session_start < batch.last_end AND prior.session_end > batch.first_start
+    ), '{}'::tstzmultirange) AS online
+    FROM batch
+), parts AS (
+    SELECT counted.user_id, day::date AS day,
+           LEAST(upper(span) AT TIME ZONE 'UTC', day + interval '1 day')
+               - GREATEST(lower(span) AT TIME ZONE 'UTC', day) AS online_time
+    FROM counted,
+         unnest(counted.online) AS span,
+         generate_series(date_trunc('day', lower(span) AT TIME ZONE 'UTC'), upper(span) AT TIME ZONE 'UTC',
+                         interval '1 day') AS day
+)
+INSERT INTO user_online_daily (user_id, day, online_time)
+SELECT user_id, day, sum(online_time) FROM parts GROUP BY user_id, day
+ON CONFLICT (user_id, day) DO UPDATE SET online_time = user_online_daily.online_time + EXCLUDED.online_time
+"""
+
+
+async def install_online_time_schema(connection):
+    """
+    Create the columns, indexes and table the online-time accounting relies on.
+    Run from python -m app.install_schema, never at worker startup: adding a
+    column locks user_online_time.
+
+    Args:
+        connection (asyncpg.Connection): A raw asyncpg connection, not in a transaction.
+
+    Returns:
+        None
+    """
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", ONLINE_TIME_LOCK_ID)
+        for statement in ONLINE_TIME_DDL:
+            await connection.execute(statement)
+    await install_indexes(connection, ONLINE_TIME_INDEXES_DDL)
+    logger.info("Online time schema installed")
+
+
+class OnlineTimeRollup:
+    """
+    Rolls closed online sessions up into per-user daily totals every
+    ``presence_rollup_interval`` seconds, after closing the sessions orphaned by
+    a dead process: those not touched for three ``presence_touch_interval``.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._rollup_periodically())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.rollup()
+
+    async def rollup(self):
+        try:
+            async with engine_asinc.begin() as conn:
+                # Every worker rolls up: one at a time, so each sees what the last one counted
+                await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": ONLINE_TIME_LOCK_ID})
+                await conn.execute(text(SWEEP_SQL), {"grace": 3 * settings.presence_touch_interval})
+                await conn.execute(text(ROLLUP_SQL))
+        except Exception as e:
+            logger.error(f"Error rolling up online time: {e}", exc_info=True)
+
+    async def _rollup_periodically(self):
+        while True:
+            await asyncio.sleep(settings.presence_rollup_interval)
+            await self.rollup()
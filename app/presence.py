@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set
+
+from .broker import NOTIFY_PAYLOAD_LIMIT
+from .config import settings
+from .database import async_session_maker
+from .routers.func_notification import update_users_status, users_online_start, users_online_end
+from .routers.func_notification import touch_online_sessions
+from .routers.func_notification import get_online_room_counts
+
+logger = logging.getLogger(__name__)
+
+
+# Identifies this process in the presence events shared through the broker
+NODE_ID = uuid.uuid4().hex
+
+# Encoded size of the user ids in one presence event, what's left of a NOTIFY
+# payload goes to the node id and the keys
+PRESENCE_CHUNK_BYTES = NOTIFY_PAYLOAD_LIMIT - 200
+
+
+def chunk_ids(user_ids: Iterable[int], size: int = PRESENCE_CHUNK_BYTES) -> List[List[int]]:
+    """
+    Split user ids into lists whose JSON encoding stays within ``size`` bytes.
+    """
+    chunks: List[List[int]] = []
+    chunk: List[int] = []
+    used = 0
+    for user_id in user_ids:
+        cost = len(str(user_id)) + 1
+        if chunk and used + cost > size:
+            chunks.append(chunk)
+            chunk, used = [], 0
+        chunk.append(user_id)
+        used += cost
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class PresenceWriter:
+    """
+    Buffers presence transitions and writes them in bulk.
+
+    Connects and disconnects only touch the in-memory buffers. Every
+    ``presence_flush_interval`` seconds the latest status of each user goes out in
+    one UPDATE, and the online sessions that started or ended in one statement each.
+    A user who drops and comes back within an interval (a flap) costs nothing.
+
+    Only the sessions this process opened are closed, by the IDs the INSERT gave
+    back. They are touched every ``presence_touch_interval`` seconds, so the ones
+    a dead process leaves open can be told apart and swept by app.online_time.
+    """
+
+    def __init__(self):
+        self.statuses: Dict[int, bool] = {}
+        self.session_starts: Dict[int, datetime] = {}
+        self.session_ends: Dict[int, datetime] = {}
+        # Open session written by this process, per user
+        self.session_ids: Dict[int, int] = {}
+        self.touched_at = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def connected(self, user_id: int):
+        """
+        Record that the first socket of a user opened.
+        """
+        self.statuses[user_id] = True
+        # Back before the previous session was written: it just goes on
+        if self.session_ends.pop(user_id, None) is None:
+            self.session_starts[user_id] = datetime.now(timezone.utc)
+
+    def disconnected(self, user_id: int):
+        """
+        Record that the last socket of a user closed.
+        """
+        self.statuses[user_id] = False
+        if self.session_starts.pop(user_id, None) is None:
+            self.session_ends[user_id] = datetime.now(timezone.utc)
+
+    async def flush(self):
+        """
+        Write everything buffered since the previous flush.
+        """
+        statuses, self.statuses = self.statuses, {}
+        starts, self.session_starts = self.session_starts, {}
+        ends, self.session_ends = self.session_ends, {}
+        if not (statuses or starts or ends):
+            return
+        async with async_session_maker() as session:
+            if statuses:
+                await update_users_status(session, statuses)
+            if settings.presence_track_online_time:
+                ends = {self.session_ids.pop(user_id): end
+                        for user_id, end in ends.items() if user_id in self.session_ids}
+                if ends:
+                    await users_online_end(session, ends)
+                if starts:
+                    self.session_ids.update(await users_online_start(session, starts))
+
+    async def touch(self):
+        """
+        Mark the sessions this process keeps open as still going.
+        """
+        self.touched_at = time.monotonic()
+        if settings.presence_track_online_time and self.session_ids:
+            async with async_session_maker() as session:
+                await touch_online_sessions(session, list(self.session_ids.values()))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(settings.presence_flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self.touched_at >= settings.presence_touch_interval:
+                    await self.touch()
+            except Exception as e:
+                logger.error(f"Error flushing presence: {e}", exc_info=True)
+
+
+class PresenceIndex:
+    """
+    Who is online, across every worker and node.
+
+    Users with a socket on this process come straight from the connection
+    registry. The other nodes' users are learned from presence events on the
+    broker: each node publishes its changes every ``presence_flush_interval``
+    seconds and a full snapshot every ``presence_sync_interval`` seconds (and when
+    a node joins). A node that misses three snapshots in a row is forgotten.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.remote: Dict[str, Set[int]] = {}
+        self.remote_seen: Dict[str, float] = {}
+        self.changes: Dict[int, bool] = {}
+        self._room_counts: Optional[Dict[str, int]] = None
+        self._room_counts_at = 0.0
+        self._tasks: List[asyncio.Task] = []
+        manager.broker.subscribe(self._on_event)
+
+    async def start(self):
+        await self.manager.broker.publish({"presence_hello": NODE_ID})
+        self._tasks = [
+            asyncio.create_task(self._publish_periodically()),
+            asyncio.create_task(self._sync_periodically()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.manager.broker.publish({"presence_down": NODE_ID})
+
+    def changed(self, user_id: int, online: bool):
+        """
+        Record that the first socket of a user opened or the last one closed on
+        this process, to be published with the next batch.
+        """
+        self.changes[user_id] = online
+
+    def is_online(self, user_id: int) -> bool:
+        if self.manager.is_connected(user_id):
+            return True
+        return any(user_id in user_ids for user_ids in self.remote.values())
+
+    def online_many(self, user_ids: Iterable[int]) -> Dict[int, bool]:
+        return {user_id: self.is_online(user_id) for user_id in user_ids}
+
+    def online_user_ids(self) -> Set[int]:
+        online = set(self.manager.user_connections)
+        for user_ids in self.remote.values():
+            online |= user_ids
+        return online
+
+    async def room_counts(self) -> Dict[str, int]:
+        """
+        Online users per user_status.name_room. The rooms live in the database, so
+        the counts are computed with one grouped query and reused for
+        ``presence_room_counts_ttl`` seconds.
+        """
+        now = time.monotonic()
+        if self._room_counts is None or now - self._room_counts_at > settings.presence_room_counts_ttl:
+            async with async_session_maker() as session:
+                counts = await get_online_room_counts(session, self.online_user_ids())
+            if counts is None:
+                return self._room_counts or {}
+            self._room_counts, self._room_counts_at = counts, now
+        return self._room_counts
+
+    async def publish_changes(self):
+        changes, self.changes = self.changes, {}
+        online = [user_id for user_id, is_online in changes.items() if is_online]
+        offline = [user_id for user_id, is_online in changes.items() if not is_online]
+        for chunk in chunk_ids(online):
+            await self.manager.broker.publish({"presence": NODE_ID, "online": chunk, "offline": []})
+        for chunk in chunk_ids(offline):
+            await self.manager.broker.publish({"presence": NODE_ID, "online": [], "offline": chunk})
+
+    async def publish_snapshot(self):
+        chunks = chunk_ids(self.manager.user_connections) or [[]]
+        for i, chunk in enumerate(chunks):
+            await self.manager.broker.publish({
+                "presence_snapshot": NODE_ID,
+                "first": i == 0,
+                "user_ids": chunk,
+            })
+
+    def _on_event(self, event: dict):
+        if "presence" in event:
+            node = event["presence"]
+            if node == NODE_ID:
+                return
+            user_ids = self.remote.setdefault(node, set())
+            user_ids.update(event.get("online", ()))
+            user_ids.difference_update(event.get("offline", ()))
+            self.remote_seen.setdefault(node, time.monotonic())
+        elif "presence_snapshot" in event:
+            node = event["presence_snapshot"]
+            if node == NODE_ID:
+                return
+            if event.get("first"):
+                self.remote[node] = set()
+            self.remote.setdefault(node, set()).update(event.get("user_ids", ()))
+            self.remote_seen[node] = time.monotonic()
+        elif "presence_hello" in event:
+            if event["presence_hello"] != NODE_ID:
+                asyncio.create_task(self.publish_snapshot())
+        elif "presence_down" in event:
+            self.remote.pop(event["presence_down"], None)
+            self.remote_seen.pop(event["presence_down"], None)
+
+    async def _publish_periodically(self):
+        while True:
+            await asyncio.sleep(settings.presence_flush_interval)
+            try:
+                await self.publish_changes()
+            except Exception as e:
+                logger.error(f"Error publishing presence: {e}", exc_info=True)
+
+    async def _sync_periodically(self):
+        while True:
+            await asyncio.sleep(settings.presence_sync_interval)
+            expired = time.monotonic() - 3 * settings.presence_sync_interval
+            for node, seen in list(self.remote_seen.items()):
+                if seen < expired:
+                    self.remote.pop(node, None)
+                    self.remote_seen.pop(node, None)
+            try:
+                await self.publish_snapshot()
+            except Exception as e:
+                logger.error(f"Error publishing presence snapshot: {e}", exc_info=True)
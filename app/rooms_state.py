@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from typing import Optional
+
+from .config import settings
+from .database import async_session_maker
+from .routers.func_notification import get_rooms_digest
+
+logger = logging.getLogger(__name__)
+
+
+class RoomsStateCache:
+    """
+    Process-wide, versioned snapshot of the rooms table.
+
+    The table is fingerprinted once per refresh (on a rooms NOTIFY and every
+    ``rooms_state_interval`` seconds as a safety net). ``version`` only grows when
+    the fingerprint changes, so a socket just compares the integer it saw last.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.version = 0
+        self.digest: Optional[str] = None
+        self._dirty = False
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._interval_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """
+        Load the initial snapshot and start the periodic refresh.
+        """
+        await self.refresh()
+        self._interval_task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self):
+        for task in (self._interval_task, self._refresh_task):
+            if task:
+                task.cancel()
+        self._interval_task = None
+        self._refresh_task = None
+
+    def schedule_refresh(self):
+        """
+        Ask for a refresh. Bursts of calls collapse into at most one running refresh
+        plus one follow-up.
+        """
+        self._dirty = True
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_pending())
+
+    async def refresh(self) -> bool:
+        """
+        Re-fingerprint the rooms table and bump the version if it changed.
+
+        Returns:
+            bool: True if the rooms changed since the previous refresh.
+        """
+        try:
+            async with async_session_maker() as session:
+                digest = await get_rooms_digest(session)
+        except Exception as e:
+            logger.error(f"Error refreshing rooms state: {e}", exc_info=True)
+            return False
+
+        if self.version and digest == self.digest:
+            return False
+        self.digest = digest
+        self.version += 1
+        self.manager.notify_all("rooms")
+        return True
+
+    async def _refresh_pending(self):
+        while self._dirty:
+            self._dirty = False
+            await self.refresh()
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(settings.rooms_state_interval)
+            self.schedule_refresh()
@@ -7,7 +7,6 @@ from sqlalchemy.future import select
 
 from .. import database, schemas, models, utils, oauth2
 
-logging.basicConfig(filename='_log/authentication.log', format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=['Authentication'])
@@ -27,12 +26,13 @@ async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Asy
     JSON object with the access token and the token type.
 
     Raises:
-    HTTPException: 403 Forbidden error if the credentials are invalid.
+    HTTPException: 401 Unauthorized error if the credentials are invalid.
 
     The function performs the following steps:
     - Extracts the username and password from the OAuth2PasswordRequestForm.
     - Verifies that a user with the provided email exists in the database.
-    - Checks if the provided password is correct.
+    - Checks if the provided password is correct (bcrypt runs in utils.hash_executor,
+      off the event loop).
     - Generates an access token using the user's ID.
     - Returns the access token and the token type as a JSON object.
     """
@@ -42,19 +42,19 @@ async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Asy
         query = select(models.User).where(models.User.email == user_credentials.username)
         result = await db.execute(query)
         user = result.scalar_one_or_none()
-        if not user or not utils.verify(user_credentials.password, user.password):
+        if not user or not await utils.async_verify(user_credentials.password, user.password):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials")
 
-        access_token = await oauth2.create_access_token(data={"user_id": user.id})
+        access_token = oauth2.create_access_token(data={"user_id": user.id})
 
         # Return the token
         return {"access_token": access_token, "token_type": "bearer"}
     except HTTPException as exc_info:
-        logging.error(f"Error login user {exc_info}")
+        logger.warning(f"Error login user {exc_info}")
         # Re-raise HTTPExceptions without modification
         raise
     except Exception as e:
         # Log the exception or handle it as you see fit
-        print(f"An error occurred: {e}")
+        logger.error(f"Error login user: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while processing the request.")
 
@@ -1,145 +1,330 @@
 
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from http.client import HTTPException
-from typing import Optional
+from typing import Dict, Optional
 import logging
 
 import pytz
 from app import models
 from app.config import settings
+from app.metrics import timed
+from app.utils import TTLCache
 from sqlalchemy.future import select
-from sqlalchemy import Interval, update, insert
+from sqlalchemy import Boolean, Integer, Interval, any_, update, insert, literal
+from sqlalchemy.sql.sqltypes import TIMESTAMP
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import func
 
 from app.schemas import InvitationSchema
-import base64
-from cryptography.fernet import Fernet, InvalidToken
 
 # Configure logging
-logging.basicConfig(filename='_log/func_notification.log', format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
 
-# Ініціалізація шифрувальника
-key = settings.key_crypto
-cipher = Fernet(key)
+# Kept importable from here, the implementation lives in app.crypto
+from app.crypto import is_base64, async_encrypt, async_decrypt, async_encrypt_many, async_decrypt_many
 
-def is_base64(s):
-    try:
-        return base64.b64encode(base64.b64decode(s)).decode('utf-8') == s
-    except Exception:
-        return False
+@timed
+async def get_pending_invitations(session: AsyncSession, user_id: int):
+    """
+    Retrieve a list of all the pending room invitations sent to the specified user.
 
-async def async_encrypt(data: Optional[str]):
-    if data is None:
-        return None
-    
-    encrypted = cipher.encrypt(data.encode())
-    encoded_string = base64.b64encode(encrypted).decode('utf-8')
-    return encoded_string
+    Args:
+        session (AsyncSession): The database session.
+        user_id (int): The ID of the user.
 
-async def async_decrypt(encoded_data: Optional[str]):
-    if encoded_data is None:
-        return None
-    
-    if not is_base64(encoded_data):
-        return encoded_data
+    Returns:
+        List[Dict[str, Any]]: Information about the pending invitations. Each
+            invitation is represented as a dictionary with the keys "room",
+            "sender", and "invitation_id".
+    """
+    invitations = await get_pending_invitations_for_users(session, [user_id])
+    if invitations is None:
+        return []
+    return invitations[user_id]
+
+def int_array(values):
+    """
+    Bind a list of ints as a single Postgres int[] parameter, for ``= ANY(...)``
+    and ``unnest(...)`` instead of one bind parameter per value.
+    """
+    return literal(list(values), ARRAY(Integer))
+
+def bool_array(values):
+    return literal(list(values), ARRAY(Boolean))
+
+def timestamp_array(values):
+    return literal(list(values), ARRAY(TIMESTAMP(timezone=True)))
 
+@timed
+async def get_unread_message_ids_for_users(session: AsyncSession, user_ids):
+    """
+    Retrieve the ids of the unread private messages of several users in one query.
+
+    Args:
+        session (AsyncSession): The database session.
+        user_ids (Iterable[int]): The IDs of the users.
+
+    Returns:
+        Dict[int, Set[int]] or None: Unread message ids per user (users without unread
+            messages map to an empty set), or None if the query failed.
+    """
     try:
-        encrypted = base64.b64decode(encoded_data.encode('utf-8'))
-        decrypted = cipher.decrypt(encrypted).decode('utf-8')
-        return decrypted
-    except InvalidToken:
-        return None  
+        result = await session.execute(
+            select(models.PrivateMessage.receiver_id, models.PrivateMessage.id)
+            .filter(models.PrivateMessage.receiver_id == any_(int_array(user_ids)),
+                    models.PrivateMessage.is_read == True)
+        )
+        unread_ids = {user_id: set() for user_id in user_ids}
+        for receiver_id, message_id in result.all():
+            unread_ids[receiver_id].add(message_id)
+        return unread_ids
+    except Exception as e:
+        logger.error(f"Error retrieving unread message ids: {e}", exc_info=True)
+        return None
 
-async def check_new_messages(session: AsyncSession, user_id: int):
+@timed
+async def check_new_messages_for_users(session: AsyncSession, message_ids):
     """
-    Retrieve a list of all the unread private messages sent to the specified user.
+    Retrieve the given unread private messages of several users in one query.
+
+    Sequence ids are not handed out in commit order, so the messages to fetch are
+    named by id (the unread ids a user has not been sent yet) rather than taken
+    above a high-water mark.
 
     Args:
         session (AsyncSession): The database session.
-        user_id (int): The ID of the user.
+        message_ids (Dict[int, Iterable[int]]): The message ids to fetch, per user ID.
 
     Returns:
-        List[Dict[str, int]]: Information about unread messages.
+        Dict[int, List[Dict[str, int]]] or None: Information about unread messages per
+            user, or None if the query failed.
     """
     try:
-        # Fetch unread private messages and corresponding sender information
+        ids = [message_id for user_ids in message_ids.values() for message_id in user_ids]
         new_messages = await session.execute(
-            select(models.PrivateMessage.id, models.PrivateMessage.message, models.PrivateMessage.fileUrl, models.User.id.label('sender_id'), models.User.user_name)
+            select(models.PrivateMessage.id, models.PrivateMessage.receiver_id, models.PrivateMessage.fileUrl,
+                   models.User.id.label('sender_id'), models.User.user_name)
             .join(models.User, models.PrivateMessage.sender_id == models.User.id)
-            .filter(models.PrivateMessage.receiver_id == user_id, models.PrivateMessage.is_read == True)
+            .filter(models.PrivateMessage.id == any_(int_array(ids)),
+                    models.PrivateMessage.receiver_id == any_(int_array(message_ids.keys())),
+                    models.PrivateMessage.is_read == True)
+            .order_by(models.PrivateMessage.id)
         )
-        messages = new_messages.all()
-
-        # Extract relevant data for each message
-        message_data = [
-                        {
-                            "sender_id": message.sender_id,
-                            "sender": message.user_name,
-                            "message_id": message.id,
-                            "message": "Message encoded",
-                            "fileUrl": message.fileUrl,
-                        } for message in messages
-                    ]
-
 
+        message_data = {user_id: [] for user_id in message_ids}
+        for message in new_messages.all():
+            message_data[message.receiver_id].append({
+                "sender_id": message.sender_id,
+                "sender": message.user_name,
+                "message_id": message.id,
+                "message": "Message encoded",
+                "fileUrl": message.fileUrl,
+            })
         return message_data
 
     except Exception as e:
         logger.error(f"Error retrieving new messages: {e}", exc_info=True)
-        return []
+        return None
 
-async def get_pending_invitations(session: AsyncSession, user_id: int):
+@timed
+async def get_unread_counts_for_users(session: AsyncSession, user_ids):
     """
-    Retrieve a list of all the pending room invitations sent to the specified user.
+    Retrieve the unread message counts per sender of several users in one query,
+    from the unread_counters table maintained by trigger (see app.triggers).
 
     Args:
         session (AsyncSession): The database session.
-        user_id (int): The ID of the user.
+        user_ids (Iterable[int]): The IDs of the users.
 
     Returns:
-        List[Dict[str, Any]]: Information about the pending invitations. Each
-            invitation is represented as a dictionary with the keys "room",
-            "sender", and "invitation_id".
+        Dict[int, List[Dict[str, Any]]] or None: Per user, a list of dictionaries
+            with the keys "sender_id", "sender" and "count", or None if the query failed.
     """
     try:
         result = await session.execute(
-        select(models.RoomInvitation)
-        .options(joinedload(models.RoomInvitation.room), joinedload(models.RoomInvitation.sender))
-        .filter(
-            models.RoomInvitation.recipient_id == user_id,
-            models.RoomInvitation.status == 'pending'
+            select(models.UnreadCounter.receiver_id, models.UnreadCounter.sender_id,
+                   models.User.user_name, models.UnreadCounter.unread_count)
+            .join(models.User, models.UnreadCounter.sender_id == models.User.id)
+            .filter(models.UnreadCounter.receiver_id == any_(int_array(user_ids)),
+                    models.UnreadCounter.unread_count > 0)
+            .order_by(models.UnreadCounter.receiver_id, models.UnreadCounter.sender_id)
         )
-        )
-        invitations = result.scalars().all()
+        counts = {user_id: [] for user_id in user_ids}
+        for counter in result.all():
+            counts[counter.receiver_id].append({
+                "sender_id": counter.sender_id,
+                "sender": counter.user_name,
+                "count": counter.unread_count,
+            })
+        return counts
+    except Exception as e:
+        logger.error(f"Error retrieving unread counts: {e}", exc_info=True)
+        return None
 
-        invitation_data = [
-        {
-            "room": invitation.room.name_room,
-            "sender": invitation.sender.user_name,
-            "invitation_id": invitation.id
-        } for invitation in invitations
-        ]
+# Pending invitations per recipient. An entry is only dropped when a room_invitations
+# row of that recipient changes (see app.listener), the TTL is a safety net.
+invitation_cache = TTLCache(settings.invitation_cache_size, settings.invitation_cache_ttl)
+# Bumped on every invalidation, per recipient and for everyone: a query that was in
+# flight meanwhile may have read the rows before the change and is not cached
+invitation_generations: Dict[int, int] = {}
+invitation_generation = 0
 
+def invalidate_invitations(user_id: Optional[int] = None):
+    """
+    Drop the cached invitations of a recipient, or of everyone.
+    """
+    global invitation_generation
+    if user_id is None:
+        invitation_generation += 1
+        invitation_cache.clear()
+    else:
+        invitation_generations[user_id] = invitation_generations.get(user_id, 0) + 1
+        invitation_cache.pop(user_id)
+
+@timed
+async def get_pending_invitations_for_users(session: AsyncSession, user_ids):
+    """
+    Retrieve the pending room invitations of several users, from the invitation
+    cache or, for the users not cached, with one column-only query.
+
+    Args:
+        session (AsyncSession): The database session.
+        user_ids (Iterable[int]): The IDs of the users.
+
+    Returns:
+        Dict[int, List[Dict[str, Any]]] or None: Pending invitations per user, in the
+            same shape as get_pending_invitations, or None if the query failed.
+    """
+    invitation_data = {}
+    missing = []
+    for user_id in user_ids:
+        cached = invitation_cache.get(user_id)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            invitation_data[user_id] = cached
+    if not missing:
+        return invitation_data
+
+    generation = invitation_generation
+    generations = {user_id: invitation_generations.get(user_id, 0) for user_id in missing}
+    try:
+        result = await session.execute(
+            select(models.RoomInvitation.id, models.RoomInvitation.recipient_id,
+                   models.Rooms.name_room, models.User.user_name)
+            .join(models.Rooms, models.RoomInvitation.room_id == models.Rooms.id)
+            .join(models.User, models.RoomInvitation.sender_id == models.User.id)
+            .filter(
+                models.RoomInvitation.recipient_id == any_(int_array(missing)),
+                models.RoomInvitation.status == 'pending'
+            )
+            .order_by(models.RoomInvitation.id)
+        )
+
+        fetched = {user_id: [] for user_id in missing}
+        for invitation in result.all():
+            fetched[invitation.recipient_id].append({
+                "room": invitation.name_room,
+                "sender": invitation.user_name,
+                "invitation_id": invitation.id
+            })
+        for user_id, invitations in fetched.items():
+            if generation == invitation_generation and generations[user_id] == invitation_generations.get(user_id, 0):
+                invitation_cache.set(user_id, invitations)
+        invitation_data.update(fetched)
         return invitation_data
     except Exception as e:
         logger.error(f"Error retrieving pending invitations: {e}", exc_info=True)
-        return []
+        return None
 
-async def get_rooms_state(session: AsyncSession):
-    result = await session.execute(select(models.Rooms))
-    rooms = result.scalars().all()
-    return [(room.id, room.name_room, room.image_room, room.secret_room, room.owner) for room in rooms]
+@timed
+async def check_users_password(session: AsyncSession, user_ids, clear: bool):
+    """
+    Batched check_user_password: read password_changed for several users in one
+    query and optionally clear it for all of them in one update.
+
+    Args:
+        session (AsyncSession): The database session.
+        user_ids (Iterable[int]): The IDs of the users.
+        clear (bool): If True, the password_changed field will be cleared.
+
+    Returns:
+        Dict[int, datetime.datetime] or None: password_changed per user ID, or None if
+            the check failed.
+    """
+    try:
+        ids = int_array(user_ids)
+        result = await session.execute(
+            select(models.User.id, models.User.password_changed).where(models.User.id == any_(ids))
+        )
+        password_changed = dict(result.all())
+
+        if clear == True and any(value is not None for value in password_changed.values()):
+            await session.execute(
+                update(models.User)
+                .where(models.User.id == any_(ids), models.User.password_changed != None)
+                .values(password_changed=None)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+        return password_changed
+    except Exception as e:
+        logger.error(f"Error checking user password: {e}", exc_info=True)
+        return None
+
+@timed
+async def get_rooms_digest(session: AsyncSession):
+    """
+    Compute a fingerprint of the rooms table on the database side.
+
+    Args:
+        session (AsyncSession): The database session.
+
+    Returns:
+        str or None: MD5 of the (id, name_room, image_room, secret_room, owner) rows
+            ordered by id, or None if there are no rooms.
+    """
+    row = func.concat_ws('|', models.Rooms.id, models.Rooms.name_room, models.Rooms.image_room,
+                         models.Rooms.secret_room, models.Rooms.owner)
+    result = await session.execute(
+        select(func.md5(func.string_agg(row, aggregate_order_by(literal(','), models.Rooms.id))))
+    )
+    return result.scalar_one_or_none()
+
+@timed
+async def get_online_room_counts(session: AsyncSession, user_ids):
+    """
+    Count the given (online) users per user_status.name_room in one query.
+
+    Args:
+        session (AsyncSession): The database session.
+        user_ids (Iterable[int]): The IDs of the online users.
+
+    Returns:
+        Dict[str, int] or None: Number of users per room name, or None if the query failed.
+    """
+    try:
+        result = await session.execute(
+            select(models.User_Status.name_room, func.count())
+            .where(models.User_Status.user_id == any_(int_array(user_ids)))
+            .group_by(models.User_Status.name_room)
+        )
+        return dict(result.all())
+    except Exception as e:
+        logger.error(f"Error counting online users per room: {e}", exc_info=True)
+        return None
 
+@timed
 async def online(session: AsyncSession, user_id: int):
     online = await session.execute(select(models.User_Status).filter(models.User_Status.user_id == user_id, models.User_Status.status == True))
     online = online.scalars().all()
     return online
 
+@timed
 async def update_user_status(session: AsyncSession, user_id: int, is_online: bool):
     """
     Update the status of a user in the database.
@@ -167,6 +352,34 @@ async def update_user_status(session: AsyncSession, user_id: int, is_online: boo
         logger.error(f"Error updating user status for user {user_id}: {e}", exc_info=True)
         
         
+@timed
+async def update_users_status(session: AsyncSession, statuses):
+    """
+    Batched update_user_status: one UPDATE ... FROM unnest(...) for several users.
+
+    Args:
+        session (AsyncSession): The database session.
+        statuses (Dict[int, bool]): The new status per user ID.
+
+    Returns:
+        None
+    """
+    try:
+        rows = func.unnest(int_array(statuses.keys()), bool_array(statuses.values())) \
+            .table_valued("user_id", "status").render_derived()
+        await session.execute(
+            update(models.User_Status)
+            .where(models.User_Status.user_id == rows.c.user_id)
+            .values(status=rows.c.status)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        logger.info(f"User status updated for {len(statuses)} users")
+    except Exception as e:
+        logger.error(f"Error updating user status for {len(statuses)} users: {e}", exc_info=True)
+
+
+@timed
 async def check_user_password(session: AsyncSession, user_id: int, clear: bool):
     """
     Check if the password of a user has been changed and optionally clear the password_changed field.
@@ -202,60 +415,172 @@ async def check_user_password(session: AsyncSession, user_id: int, clear: bool):
         return None
 
 
+@timed
 async def user_online_start(session: AsyncSession, user_id: int):
+    """
+    Open a new online session for a user. Sessions are append-only: one INSERT,
+    no read first, so two sockets of the same user can't race.
+
+    Args:
+        session (AsyncSession): The database session.
+        user_id (int): The ID of the user.
+
+    Returns:
+        int or None: The ID of the new session, or None if the insert failed.
+    """
     try:
-        timezone = pytz.timezone('UTC')
-        current_time_utc = datetime.now(timezone)
-        logger.info(f"Updating online session start for user {user_id} at {current_time_utc}")
+        current_time_utc = datetime.now(pytz.utc)
+        result = await session.execute(
+            insert(models.UserOnlineTime)
+            .values(user_id=user_id, session_start=current_time_utc, last_seen=current_time_utc,
+                    total_online_time=timedelta(0))
+            .returning(models.UserOnlineTime.id)
+        )
+        await session.commit()
+        return result.scalar_one()
+    except Exception as e:
+        logger.error(f"Error starting user online session: {e}", exc_info=True)
+        return None
 
-        # Перевірка наявності запису
+@timed
+async def users_online_start(session: AsyncSession, starts):
+    """
+    Batched user_online_start: open a new online session for several users in one
+    INSERT ... SELECT FROM unnest(...).
+
+    Args:
+        session (AsyncSession): The database session.
+        starts (Dict[int, datetime.datetime]): Session start per user ID.
+
+    Returns:
+        Dict[int, int]: The ID of the new session per user ID, empty if the insert failed.
+    """
+    try:
+        rows = func.unnest(int_array(starts.keys()), timestamp_array(starts.values())) \
+            .table_valued("user_id", "session_start").render_derived()
         result = await session.execute(
-            select(models.UserOnlineTime).where(models.UserOnlineTime.user_id == user_id)
+            insert(models.UserOnlineTime).from_select(
+                ["user_id", "session_start", "last_seen", "total_online_time"],
+                select(rows.c.user_id, rows.c.session_start, rows.c.session_start,
+                       literal(timedelta(0), Interval))
+            ).returning(models.UserOnlineTime.user_id, models.UserOnlineTime.id)
         )
-        user_online_record = result.scalar_one_or_none()
+        session_ids = dict(result.all())
+        await session.commit()
+        return session_ids
+    except Exception as e:
+        logger.error(f"Error starting online sessions for {len(starts)} users: {e}", exc_info=True)
+        return {}
 
-        if user_online_record is None:
-            # Створення нового запису
-            await session.execute(
-                insert(models.UserOnlineTime).values(user_id=user_id, session_start=current_time_utc)
-            )
-        else:
-            # Оновлення існуючого запису
-            await session.execute(
-                update(models.UserOnlineTime)
-                .where(models.UserOnlineTime.user_id == user_id)
-                .values(session_start=current_time_utc, session_end=None)
-            )
+def close_online_sessions(session_id, session_end):
+    """
+    The single UPDATE that closes an open session (or those of a derived table of
+    session IDs) and stores its own duration. Only sessions this process opened
+    are closed by ID, the ones left open by a process that died are swept by
+    app.online_time. Daily totals are rolled up separately, there too.
+    """
+    return (
+        update(models.UserOnlineTime)
+        .where(models.UserOnlineTime.id == session_id,
+               models.UserOnlineTime.session_end == None,
+               models.UserOnlineTime.session_start <= session_end)
+        .values(
+            session_end=session_end,
+            total_online_time=session_end - models.UserOnlineTime.session_start
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+@timed
+async def users_online_end(session: AsyncSession, ends):
+    """
+    Batched user_online_end: close several online sessions in one
+    UPDATE ... FROM unnest(...).
+
+    Args:
+        session (AsyncSession): The database session.
+        ends (Dict[int, datetime.datetime]): Session end per session ID.
+
+    Returns:
+        None
+    """
+    try:
+        rows = func.unnest(int_array(ends.keys()), timestamp_array(ends.values())) \
+            .table_valued("session_id", "session_end").render_derived()
+        await session.execute(close_online_sessions(rows.c.session_id, rows.c.session_end))
         await session.commit()
-        
     except Exception as e:
-        logger.error(f"Error updating user online session: {e}", exc_info=True)
+        logger.error(f"Error ending {len(ends)} online sessions: {e}", exc_info=True)
+
+@timed
+async def user_online_end(session: AsyncSession, session_id: int):
+    """
+    Close an online session opened by user_online_start in one UPDATE.
+
+    Args:
+        session (AsyncSession): The database session.
+        session_id (int): The ID returned by user_online_start.
 
-async def user_online_end(session: AsyncSession, user_id: int):
+    Returns:
+        None
+    """
+    try:
+        current_time_utc = datetime.now(pytz.utc)
+        await session.execute(close_online_sessions(session_id, literal(current_time_utc, TIMESTAMP(timezone=True))))
+        await session.commit()
+    except Exception as e:
+        logger.error(f"Error ending user online session: {e}", exc_info=True)
+
+@timed
+async def touch_online_sessions(session: AsyncSession, session_ids):
+    """
+    Record that the given open sessions are still going, in one UPDATE. Sessions
+    left open by a process that died stop being touched, and app.online_time
+    closes them at the last time they were.
+
+    Args:
+        session (AsyncSession): The database session.
+        session_ids (Iterable[int]): IDs of the sessions this process keeps open.
+
+    Returns:
+        None
+    """
+    try:
+        await session.execute(
+            update(models.UserOnlineTime)
+            .where(models.UserOnlineTime.id == any_(int_array(session_ids)),
+                   models.UserOnlineTime.session_end == None)
+            .values(last_seen=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    except Exception as e:
+        logger.error(f"Error touching online sessions: {e}", exc_info=True)
+
+@timed
+async def get_daily_online_time(session: AsyncSession, user_id: int, start_day: date, end_day: date):
+    """
+    Retrieve the rolled-up online time of a user per day.
+
+    Args:
+        session (AsyncSession): The database session.
+        user_id (int): The ID of the user.
+        start_day (datetime.date): First day (UTC) of the range, inclusive.
+        end_day (datetime.date): Last day (UTC) of the range, inclusive.
+
+    Returns:
+        Dict[datetime.date, datetime.timedelta] or None: Online time per day, days
+            without any are left out. None if the query failed.
+    """
     try:
-        timezone = pytz.timezone('UTC')
-        current_time_utc = datetime.now(timezone)
-        
-        # Отримати останній запис сесії користувача
         result = await session.execute(
-            select(models.UserOnlineTime)
-            .where(models.UserOnlineTime.user_id == user_id)
-            .order_by(models.UserOnlineTime.session_start.desc())
-            .limit(1)
+            select(models.UserOnlineDaily.day, models.UserOnlineDaily.online_time)
+            .where(models.UserOnlineDaily.user_id == user_id,
+                   models.UserOnlineDaily.day >= start_day,
+                   models.UserOnlineDaily.day <= end_day)
+            .order_by(models.UserOnlineDaily.day)
         )
-        user_online_record = result.scalar_one()
-        
-        if user_online_record.session_start:
-            session_duration = current_time_utc - user_online_record.session_start
-            
-            await session.execute(
-                update(models.UserOnlineTime)
-                .where(models.UserOnlineTime.id == user_online_record.id)
-                .values(
-                    session_end=current_time_utc,
-                    total_online_time=models.UserOnlineTime.total_online_time + func.cast(session_duration, Interval)
-                )
-            )
-            await session.commit()
+        return dict(result.all())
     except Exception as e:
-        logger.error(f"Error ending user online session: {e}", exc_info=True)
+        logger.error(f"Error retrieving daily online time: {e}", exc_info=True)
+        return None
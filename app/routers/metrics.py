@@ -0,0 +1,15 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from app import metrics as app_metrics
+
+
+router = APIRouter(tags=['Metrics'])
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Prometheus metrics of this worker, or of all workers with PROMETHEUS_MULTIPROC_DIR set.
+    """
+    return Response(app_metrics.render(), media_type=CONTENT_TYPE_LATEST)
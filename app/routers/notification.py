@@ -1,100 +1,517 @@
 import asyncio
 import logging
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from app.connection_manager import ConnectionManagerNotification
-from app.database import get_async_session
+from typing import Dict, List, Optional, Set
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from app.broker import create_broker
+from app.connection_manager import ENCODINGS, ConnectionManagerNotification, SlowConsumerError, make_frame
+from app.event_log import EventLog
+from app.listener import NotificationListener
+from app.online_time import OnlineTimeRollup
+from app.presence import PresenceIndex, PresenceWriter
+from app.rooms_state import RoomsStateCache
+from app.config import settings
+from app.database import async_session_maker
 from app import oauth2
-from .func_notification import get_rooms_state, online, check_new_messages, update_user_status, get_pending_invitations, check_user_password
-from .func_notification import user_online_start, user_online_end
-from sqlalchemy.ext.asyncio import AsyncSession
+from app.metrics import CONNECTIONS_REJECTED
+from app.utils import RateLimiter, TTLCache
+from .func_notification import check_users_password
+from .func_notification import get_unread_message_ids_for_users, check_new_messages_for_users, get_pending_invitations_for_users
+from .func_notification import get_unread_counts_for_users
 
 
 
 
 # Configure logging
-logging.basicConfig(filename='_log/notification.log', format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
-manager = ConnectionManagerNotification()
+manager = ConnectionManagerNotification(create_broker())
+rooms_state = RoomsStateCache(manager)
+listener = NotificationListener(manager, rooms_state)
+presence = PresenceWriter()
+presence_index = PresenceIndex(manager)
+online_time = OnlineTimeRollup()
+# Admission control: token buckets on connects and on inbound frames, per client
+# IP and per user, and the sockets still being authenticated towards the
+# notification_max_sockets cap of this worker
+connect_ip_limiter = RateLimiter(settings.notification_connect_rate_ip, settings.notification_connect_burst_ip)
+connect_user_limiter = RateLimiter(settings.notification_connect_rate_user, settings.notification_connect_burst_user)
+message_ip_limiter = RateLimiter(settings.notification_message_rate_ip, settings.notification_message_burst_ip)
+message_user_limiter = RateLimiter(settings.notification_message_rate_user, settings.notification_message_burst_user)
+admitting: Set[WebSocket] = set()
+
+
+class UserInbox:
+    """
+    What has already been sent to the sockets of one user.
+    """
+
+    def __init__(self, password_changed):
+        # Unread messages already sent, only the unread ids missing here are
+        # fetched in full
+        self.unread_messages = {}
+        self.invitations = []
+        self.invitation_ids = set()
+        self.password_changed = password_changed
+        # Unread counts per sender, for the sockets that asked for the summary
+        self.unread_summary = None
+
+    def messages(self):
+        """
+        The unread messages sent, oldest first.
+        """
+        return [self.unread_messages[message_id] for message_id in sorted(self.unread_messages)]
+
+
+class NotificationScheduler:
+    """
+    Central loop behind every /notification socket of this process.
+
+    Change signals collected by the manager are handled at most once per
+    ``notification_batch_interval``: one grouped query per change kind covers every
+    affected user (``= ANY(:ids)``), and each socket is then handed its own slice.
+
+    Every frame sent to a user is logged in ``event_log`` and carries its ``seq``.
+    The inbox of a user whose last socket closed is kept for a while, so a client
+    reconnecting with that cursor only gets what it missed.
+    """
+
+    def __init__(self, manager: ConnectionManagerNotification, rooms_state: RoomsStateCache):
+        self.manager = manager
+        self.rooms_state = rooms_state
+        self.rooms_version = 0
+        # seq of the last room update, replayed to a client resuming from before it
+        self.rooms_seq = 0
+        self.inboxes: Dict[int, UserInbox] = {}
+        self.parked_inboxes = TTLCache(settings.notification_event_log_users, settings.notification_event_log_ttl)
+        self.event_log = EventLog(settings.notification_event_log_size, settings.notification_event_log_ttl)
+        self.delta_sockets: Set[WebSocket] = set()
+        self.summary_sockets: Set[WebSocket] = set()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self.rooms_version = self.rooms_state.version
+        await self.event_log.start()
+        self._tasks = [asyncio.create_task(self._run())]
+        if settings.notification_reconcile_interval > 0:
+            self._tasks.append(asyncio.create_task(self._reconcile()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.event_log.stop()
+
+    async def register(self, websocket: WebSocket, user_id: int, delta: bool, password_changed, summary: bool = False,
+                       since: Optional[int] = None):
+        """
+        Starts delivering notifications of a user to a connected socket. What the
+        user's other sockets already know is sent right away, the rest is fetched
+        on the next tick.
+
+        With ``since`` (the last seq the client saw), a delta socket is only sent
+        the events logged after it, and the changes made while the user was offline
+        come on the next tick. A cursor the log can't serve gets a "resync" frame
+        and the full state.
+        """
+        if delta:
+            self.delta_sockets.add(websocket)
+        if summary:
+            self.summary_sockets.add(websocket)
+        inbox = self.inboxes.get(user_id)
+        parked = self.parked_inboxes.get(user_id)
+        self.parked_inboxes.pop(user_id)
+        replay = None
+        if since is not None:
+            replay = self.event_log.since(user_id, since) if inbox is not None or parked is not None else None
+            if replay is None:
+                self._send(websocket, make_frame({"resync": True}, "resync"))
+            elif inbox is None:
+                # Keeps the password_changed it was parked with, and is checked on
+                # the next tick: the NOTIFY of a change made while the user was
+                # away found no socket, and the client still has to be logged out
+                inbox = self.inboxes[user_id] = parked
+                self.manager.notify_user(user_id, "password")
+
+        if inbox is None:
+            self.inboxes[user_id] = UserInbox(password_changed)
+        elif replay is not None:
+            # Room updates concern everyone and are not logged per user
+            if since < self.rooms_seq:
+                replay.append(make_frame({"update": "room update", "seq": self.rooms_seq}, "rooms"))
+                replay.sort(key=lambda frame: frame.data["seq"])
+            self._replay(websocket, inbox, replay)
+        else:
+            seq = self.event_log.cursor(user_id)
+            messages = inbox.messages()
+            if summary:
+                if inbox.unread_summary:
+                    self._send(websocket, make_frame({"unread_summary": inbox.unread_summary, "seq": seq}, "summary"))
+            elif messages:
+                self._send(websocket, make_frame(self._messages_frame(websocket, messages, messages, set(), seq), "messages"))
+            if inbox.invitations:
+                self._send(websocket, make_frame(dict(self._invitations_frame(inbox.invitations), seq=seq), "invitations"))
+        self.manager.notify_user(user_id, "messages")
+        self.manager.notify_user(user_id, "invitations")
+
+    def _replay(self, websocket: WebSocket, inbox: UserInbox, replay):
+        """
+        Sends a resuming socket the frames logged after its cursor, in its own
+        variant: message deltas become the full list for sockets that didn't ask
+        for deltas, and only summary sockets get summaries (and no messages).
+        """
+        for frame in replay:
+            if frame.key == "messages":
+                if websocket in self.summary_sockets:
+                    continue
+                if websocket not in self.delta_sockets:
+                    messages = inbox.messages()
+                    frame = make_frame(self._messages_frame(websocket, messages, messages, set(), frame.data["seq"]), "messages")
+            elif frame.key == "summary" and websocket not in self.summary_sockets:
+                continue
+            self._send(websocket, frame)
+
+    def unregister(self, websocket: WebSocket, user_id: int):
+        self.delta_sockets.discard(websocket)
+        self.summary_sockets.discard(websocket)
+        if not self.manager.is_connected(user_id):
+            inbox = self.inboxes.pop(user_id, None)
+            if inbox is not None:
+                self.parked_inboxes.set(user_id, inbox)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            changes, broadcasts = await self.manager.wait_for_changes()
+            started = loop.time()
+            try:
+                await self.process(changes, broadcasts)
+            except Exception as e:
+                logger.error(f"Error processing notification changes: {e}", exc_info=True)
+            # Whatever arrives meanwhile is handled together on the next tick
+            await asyncio.sleep(max(0.0, settings.notification_batch_interval - (loop.time() - started)))
+
+    async def _reconcile(self):
+        # Safety net for changes that did not come through NOTIFY
+        while True:
+            await asyncio.sleep(settings.notification_reconcile_interval)
+            for kind in ("password", "messages", "invitations"):
+                self.manager.notify_all(kind)
+
+    async def process(self, changes: Dict[str, Set[int]], broadcasts: Set[str]):
+        """
+        Runs the batched queries for one tick and sends the results.
+        """
+        def affected(kind):
+            user_ids = self.inboxes.keys() if kind in broadcasts else changes.get(kind, set())
+            return [user_id for user_id in user_ids if user_id in self.inboxes]
+
+        if "rooms" in broadcasts and self.rooms_version != self.rooms_state.version:
+            self.rooms_version = self.rooms_state.version
+            self.rooms_seq = self.event_log.append((), "rooms", None)
+            self.manager.send_all({"update": "room update", "seq": self.rooms_seq}, "rooms")
+
+        async with async_session_maker() as session:
+            for user_ids in chunks(affected("password")):
+                await self._process_password(session, user_ids)
+            for user_ids in chunks(affected("messages")):
+                await self._process_messages(session, user_ids)
+            for user_ids in chunks(affected("invitations")):
+                await self._process_invitations(session, user_ids)
+
+    async def _process_password(self, session, user_ids):
+        # password_changed is compared with the value each inbox recorded at connect
+        # and never cleared: every worker and node holding sockets of the user has
+        # to see the change, not just the first one to read it
+        password_changed = await check_users_password(session, user_ids, False)
+        if password_changed is None:
+            return
+        logged_out = []
+        for user_id in user_ids:
+            inbox = self.inboxes.get(user_id)
+            changed = password_changed.get(user_id)
+            if inbox is None or changed is None or inbox.password_changed == changed:
+                continue
+            inbox.password_changed = changed
+            logged_out.append(user_id)
+        if not logged_out:
+            return
+        seq = self.event_log.append(logged_out, "logout", {"logout": True})
+        frame = make_frame({"logout": True, "seq": seq}, "logout")
+        self._send_all([(websocket, frame) for user_id in logged_out for websocket in self._sockets(user_id)])
+
+    async def _process_messages(self, session, user_ids):
+        summary_ids = [
+            user_id for user_id in user_ids
+            if any(websocket in self.summary_sockets for websocket in self._sockets(user_id))
+        ]
+        if summary_ids:
+            await self._process_summaries(session, summary_ids)
+        # Users whose sockets all asked for the summary don't need the full rows
+        user_ids = [
+            user_id for user_id in user_ids
+            if any(websocket not in self.summary_sockets for websocket in self._sockets(user_id))
+        ]
+        if not user_ids:
+            return
+
+        unread_ids = await get_unread_message_ids_for_users(session, user_ids)
+        if unread_ids is None:
+            return
+        # Ids are not committed in order (and a message can become unread again),
+        # so every unread id not in the inbox yet is fetched, not just the higher ones
+        missing_ids = {
+            user_id: unread_ids[user_id] - self.inboxes[user_id].unread_messages.keys() for user_id in user_ids
+            if user_id in self.inboxes
+        }
+        missing_ids = {user_id: ids for user_id, ids in missing_ids.items() if ids}
+        new_messages = await check_new_messages_for_users(session, missing_ids) if missing_ids else {}
+        if new_messages is None:
+            return
+
+        frames = []
+        for user_id in user_ids:
+            inbox = self.inboxes.get(user_id)
+            if inbox is None:
+                continue
+            added = new_messages.get(user_id, [])
+            read_ids = inbox.unread_messages.keys() - unread_ids[user_id]
+            if not added and not read_ids:
+                continue
+            for message_id in read_ids:
+                del inbox.unread_messages[message_id]
+            for msg in added:
+                inbox.unread_messages[msg['message_id']] = msg
+            messages = inbox.messages()
+            # Logged as a delta, which is what a resuming client is replayed
+            seq = self.event_log.append([user_id], "messages", self._delta_frame(messages, added, read_ids))
+            # Each frame variant is serialized once and shared by the user's sockets
+            variants = {}
+            for websocket in self._sockets(user_id):
+                if websocket in self.summary_sockets:
+                    continue
+                variant = websocket in self.delta_sockets
+                if variant not in variants:
+                    variants[variant] = make_frame(self._messages_frame(websocket, messages, added, read_ids, seq), "messages")
+                frames.append((websocket, variants[variant]))
+        self._send_all(frames)
+
+    async def _process_summaries(self, session, user_ids):
+        counts = await get_unread_counts_for_users(session, user_ids)
+        if counts is None:
+            return
+        frames = []
+        for user_id in user_ids:
+            inbox = self.inboxes.get(user_id)
+            if inbox is None or inbox.unread_summary == counts[user_id]:
+                continue
+            inbox.unread_summary = counts[user_id]
+            seq = self.event_log.append([user_id], "summary", {"unread_summary": inbox.unread_summary})
+            frame = make_frame({"unread_summary": inbox.unread_summary, "seq": seq}, "summary")
+            frames.extend(
+                (websocket, frame) for websocket in self._sockets(user_id) if websocket in self.summary_sockets
+            )
+        self._send_all(frames)
+
+    async def _process_invitations(self, session, user_ids):
+        invitations = await get_pending_invitations_for_users(session, user_ids)
+        if invitations is None:
+            return
+        frames = []
+        for user_id in user_ids:
+            inbox = self.inboxes.get(user_id)
+            if inbox is None:
+                continue
+            invitation_ids = set(inv['invitation_id'] for inv in invitations[user_id])
+            if inbox.invitation_ids == invitation_ids:
+                continue
+            inbox.invitation_ids = invitation_ids
+            inbox.invitations = invitations[user_id]
+            data = self._invitations_frame(inbox.invitations)
+            seq = self.event_log.append([user_id], "invitations", data)
+            frame = make_frame(dict(data, seq=seq), "invitations")
+            frames.extend((websocket, frame) for websocket in self._sockets(user_id))
+        self._send_all(frames)
+
+    def _messages_frame(self, websocket, messages, added, read_ids, seq):
+        """
+        At most ``notification_max_unread`` messages go in a full-list frame (the
+        oldest unread first), ``unread_total`` tells how many there are in all.
+        Deltas are never capped: a message left out of one would never be sent.
+        """
+        if websocket in self.delta_sockets:
+            return dict(self._delta_frame(messages, added, read_ids), seq=seq)
+        limit = settings.notification_max_unread or None
+        return {"new_message": messages[:limit], "unread_total": len(messages), "seq": seq}
+
+    def _delta_frame(self, messages, added, read_ids):
+        return {"new_message_delta": {"added": added, "read": sorted(read_ids), "unread_total": len(messages)}}
+
+    def _invitations_frame(self, invitations):
+        limit = settings.notification_max_invitations or None
+        return {"new_invitations": invitations[:limit], "invitations_total": len(invitations)}
+
+    def _sockets(self, user_id):
+        return list(self.manager.sockets(user_id))
+
+    def _send_all(self, frames):
+        for websocket, frame in frames:
+            self._send(websocket, frame)
+
+    def _send(self, websocket: WebSocket, frame):
+        self.manager.send_frame(websocket, frame)
+
+
+def chunks(user_ids):
+    user_ids = list(user_ids)
+    size = settings.notification_batch_size
+    for i in range(0, len(user_ids), size):
+        yield user_ids[i:i + size]
+
+
+scheduler = NotificationScheduler(manager, rooms_state)
+PONG = make_frame({"pong": True}, "pong")
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised for a client sending frames faster than its buckets allow.
+    """
+
+
+def client_ip(websocket: WebSocket) -> str:
+    # Behind a proxy, run uvicorn with --proxy-headers so this is the real client
+    return websocket.client.host if websocket.client else "unknown"
+
+
+async def reject(websocket: WebSocket, reason: str):
+    """
+    Refuses a socket with 1013 "try again later", which clients treat as a cue to
+    back off and reconnect.
+    """
+    CONNECTIONS_REJECTED.labels(reason).inc()
+    logger.warning(f"WebSocket rejected from {client_ip(websocket)}: {reason}")
+    await websocket.accept()
+    await websocket.close(code=1013, reason="Try again later")
+
+
+async def receive_client_messages(websocket: WebSocket, user_id: int):
+    """
+    Reader task of a socket. Notifications are pushed by the scheduler through
+    the writer task, so clients don't need to send anything: a "ping" (as text,
+    or as bytes from MessagePack clients) is answered with a pong, anything else
+    is ignored. With ``notification_idle_timeout`` set, a client silent for that
+    long is dropped, a client sending faster than the message limits is closed.
+    """
+    timeout = settings.notification_idle_timeout or None
+    ip = client_ip(websocket)
+    while True:
+        message = await asyncio.wait_for(websocket.receive(), timeout)
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if not (message_user_limiter.allow(user_id) and message_ip_limiter.allow(ip)):
+            raise RateLimitExceeded()
+        if message.get("text") == "ping" or message.get("bytes") == b"ping":
+            manager.send_frame(websocket, PONG)
+
+
+async def serve_connection(websocket: WebSocket, user_id: int):
+    """
+    Runs the reader and writer tasks of a socket until either of them ends, or
+    until the socket is evicted as a slow consumer, and raises whatever ended it.
+    """
+    tasks = {
+        asyncio.create_task(receive_client_messages(websocket, user_id)),
+        asyncio.create_task(manager.run_writer(websocket)),
+        asyncio.create_task(manager.wait_evicted(websocket)),
+    }
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+    for task in done:
+        task.result()
+
 
 @router.websocket("/notification")
 async def web_private_notification(
     websocket: WebSocket,
     token: str,
-    session: AsyncSession = Depends(get_async_session)):
+    delta: bool = False,
+    summary: bool = False,
+    encoding: str = "json",
+    compress: bool = False,
+    since: Optional[int] = None):
 
+    # Cheap checks first: a flood of connects is turned away before it costs a
+    # token check or a database query
+    if settings.notification_max_sockets and \
+            len(manager.active_connections) + len(admitting) >= settings.notification_max_sockets:
+        await reject(websocket, "max_sockets")
+        return
+    if not connect_ip_limiter.allow(client_ip(websocket)):
+        await reject(websocket, "connect_rate_ip")
+        return
+
+    # A session is only checked out for each short unit of work below, so an open
+    # socket doesn't hold a pooled connection for its whole lifetime.
     user = None
-    online_session_id = None
+    admitting.add(websocket)
     try:
-        user = await oauth2.get_current_user(token, session)
+        async with async_session_maker() as session:
+            user = await oauth2.get_current_user(token, session)
         if user.blocked:
             await websocket.close(code=1008)
             return
-        
-        await manager.connect(websocket, user.id)
+        if not connect_user_limiter.allow(user.id):
+            await reject(websocket, "connect_rate_user")
+            return
+
+        # Frames go out as JSON text unless the client asks for MessagePack
+        await manager.connect(websocket, user.id, encoding if encoding in ENCODINGS else "json", compress)
         logger.info(f"WebSocket connected for user {user.id}")
-        await update_user_status(session, user.id, True)
-        
-        # online_session_id = await user_online_start(session, user.id)
+        # Status and online time only change with the first and the last socket
+        # of a user, and are written in bulk by the presence writer
+        if len(manager.sockets(user.id)) == 1:
+            presence.connected(user.id)
+            presence_index.changed(user.id, True)
         
     except Exception as e:
         logger.error(f"Error in WebSocket setup for user: {e}", exc_info=True)
         await websocket.close(code=1008)
         return
+    finally:
+        admitting.discard(websocket)
 
+    close_code = 1000
     try:
-        new_messages_set = set()
-        new_invitations_set = set()
-        rooms_last_state = await get_rooms_state(session)
-        password_changed_state = await check_user_password(session, user.id, False)
-        while True:
-            await websocket.receive_text()
-            
-            await asyncio.sleep(4)
-            
-            password_changed = await check_user_password(session, user.id, True)
-            if password_changed_state != password_changed:
-                password_changed_state = password_changed
-                await websocket.send_json({"logout": True})
-                       
-            new_messages_info = await check_new_messages(session, user.id)
-
-            # Using set for efficient operations
-            current_set = set((msg['message_id'] for msg in new_messages_info))
-            if new_messages_set != current_set:
-                new_messages_set = current_set
-                await websocket.send_json({"new_message": new_messages_info})
-                
-            
-            invitations = await get_pending_invitations(session, user.id)
-            invitation_set = set((inv['invitation_id'] for inv in invitations))
-            if new_invitations_set!= invitation_set:
-                new_invitations_set = invitation_set
-                await websocket.send_json({"new_invitations": invitations})
-                
-                        # Check for changes in the Rooms table
-            current_rooms_state = await get_rooms_state(session)
-            if rooms_last_state != current_rooms_state:
-                rooms_last_state = current_rooms_state
-                await websocket.send_json({"update": "room update"})
-                
+        # The cached user follows password_changed through the users_auth_changed
+        # trigger, no need to read it again
+        await scheduler.register(websocket, user.id, delta, user.password_changed, summary, since)
+        await serve_connection(websocket, user.id)
+
     except asyncio.CancelledError:
     # Handle cancellation (cleanup, logging, etc.)
         pass  
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for user {user.id}")
+    except asyncio.TimeoutError:
+        logger.info(f"WebSocket idle timeout for user {user.id}")
+    except SlowConsumerError:
+        logger.warning(f"WebSocket evicted as a slow consumer for user {user.id}")
+    except RateLimitExceeded:
+        CONNECTIONS_REJECTED.labels("message_rate").inc()
+        logger.warning(f"WebSocket closed for sending too fast for user {user.id}")
+        close_code = 1008
     except Exception as e:
         logger.error(f"Unexpected error in WebSocket for user {user.id}: {e}", exc_info=True)
     finally:
         if user:
-            print("WebSocket disconnected")
-            await update_user_status(session, user.id, False)
-            # if online_session_id:
-            #     await user_online_end(session, online_session_id)
+            await manager.disconnect(websocket, user.id, close_code)
+            scheduler.unregister(websocket, user.id)
+            if not manager.is_connected(user.id):
+                presence.disconnected(user.id)
+                presence_index.changed(user.id, False)
                 
-        await session.close()
-        logger.info(f"WebSocket session closed for user {user.id}")
-
-    
-            
+        logger.info(f"WebSocket session closed for user {user.id}")
\ No newline at end of file
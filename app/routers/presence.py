@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+from typing import List
+import pytz
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+from app import oauth2
+from app.database import async_session_maker
+from .func_notification import get_daily_online_time
+from .notification import presence_index
+
+
+async def require_user(user: oauth2.AuthUser = Depends(oauth2.get_current_user)):
+    """
+    Presence is only served to signed-in users that are not blocked.
+    """
+    if user is None or user.blocked:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return user
+
+
+router = APIRouter(prefix="/presence", tags=['Presence'], dependencies=[Depends(require_user)])
+
+
+@router.get("")
+async def get_presence(user_ids: List[int] = Query(...)):
+    """
+    Bulk presence lookup, answered from the in-memory presence index.
+
+    Args:
+    user_ids (List[int]): The IDs of the users, e.g. ?user_ids=1&user_ids=2.
+
+    Returns:
+    JSON object mapping each user ID to whether the user is online.
+    """
+    return {"online": presence_index.online_many(user_ids)}
+
+
+@router.get("/rooms")
+async def get_rooms_presence():
+    """
+    Number of online users per room (user_status.name_room).
+    """
+    return {"rooms": await presence_index.room_counts()}
+
+
+@router.get("/{user_id}")
+async def get_user_presence(user_id: int):
+    """
+    Whether a single user is online on any worker or node.
+    """
+    return {"user_id": user_id, "online": presence_index.is_online(user_id)}
+
+
+@router.get("/{user_id}/online-time")
+async def get_user_online_time(user_id: int, days: int = Query(7, ge=1, le=366)):
+    """
+    Online time of a user per UTC day over the last ``days`` days, from the
+    rolled-up daily totals (sessions closed since the last rollup are not in yet).
+
+    Returns:
+    JSON object mapping each day (YYYY-MM-DD) to the online time in seconds.
+    """
+    end_day = datetime.now(pytz.utc).date()
+    start_day = end_day - timedelta(days=days - 1)
+    async with async_session_maker() as session:
+        online_time = await get_daily_online_time(session, user_id, start_day, end_day)
+    if online_time is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while processing the request.")
+    return {
+        "user_id": user_id,
+        "online_time": {day.isoformat(): duration.total_seconds() for day, duration in online_time.items()},
+    }
@@ -46,9 +46,9 @@ class TokenData(BaseModel):
 #     email: EmailStr
 #     password: str
 
-# class Token(BaseModel):
-#     access_token: str
-#     token_type: str
+class Token(BaseModel):
+    access_token: str
+    token_type: str
 
         
         
@@ -0,0 +1,255 @@
+import logging
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+# NOTIFY channels raised by the triggers below, mapped to the kind of change
+# the notification sockets react to.
+MESSAGES_CHANNEL = "private_messages_changed"
+INVITATIONS_CHANNEL = "room_invitations_changed"
+ROOMS_CHANNEL = "rooms_changed"
+PASSWORD_CHANNEL = "users_password_changed"
+AUTH_CHANNEL = "users_auth_changed"
+
+CHANNEL_KINDS = {
+    MESSAGES_CHANNEL: "messages",
+    INVITATIONS_CHANNEL: "invitations",
+    ROOMS_CHANNEL: "rooms",
+    PASSWORD_CHANNEL: "password",
+    AUTH_CHANNEL: "auth",
+}
+
+# Serialises concurrent installs when several workers start at once.
+TRIGGERS_LOCK_ID = 7_310_001
+
+# Created by the DDL below. DROP/CREATE TRIGGER take an ACCESS EXCLUSIVE lock on
+# the table, so workers only run it when one of them is missing.
+TRIGGER_NAMES = [
+    "private_messages_notify",
+    "room_invitations_notify",
+    "rooms_notify",
+    "users_password_notify",
+    "users_auth_notify",
+]
+
+TRIGGERS_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION notify_private_messages_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('private_messages_changed', OLD.receiver_id::text);
+        ELSE
+            PERFORM pg_notify('private_messages_changed', NEW.receiver_id::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS private_messages_notify ON private_messages",
+    """
+    CREATE TRIGGER private_messages_notify
+    AFTER INSERT OR UPDATE OR DELETE ON private_messages
+    FOR EACH ROW EXECUTE FUNCTION notify_private_messages_changed()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION notify_room_invitations_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('room_invitations_changed', OLD.recipient_id::text);
+        ELSE
+            PERFORM pg_notify('room_invitations_changed', NEW.recipient_id::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS room_invitations_notify ON room_invitations",
+    """
+    CREATE TRIGGER room_invitations_notify
+    AFTER INSERT OR UPDATE OR DELETE ON room_invitations
+    FOR EACH ROW EXECUTE FUNCTION notify_room_invitations_changed()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION notify_rooms_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('rooms_changed', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS rooms_notify ON rooms",
+    """
+    CREATE TRIGGER rooms_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON rooms
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_rooms_changed()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION notify_users_password_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('users_password_changed', NEW.id::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS users_password_notify ON users",
+    # Clearing the column back to NULL (check_user_password with clear=True)
+    # must not raise another logout, hence the WHEN clause.
+    """
+    CREATE TRIGGER users_password_notify
+    AFTER UPDATE OF password_changed ON users
+    FOR EACH ROW
+    WHEN (NEW.password_changed IS NOT NULL AND NEW.password_changed IS DISTINCT FROM OLD.password_changed)
+    EXECUTE FUNCTION notify_users_password_changed()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION notify_users_auth_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('users_auth_changed', NEW.id::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS users_auth_notify ON users",
+    # Unlike users_password_notify this also fires when password_changed is
+    # cleared, the cached user in app.oauth2 must follow every change.
+    """
+    CREATE TRIGGER users_auth_notify
+    AFTER UPDATE OF blocked, password_changed ON users
+    FOR EACH ROW
+    WHEN (NEW.blocked IS DISTINCT FROM OLD.blocked OR NEW.password_changed IS DISTINCT FROM OLD.password_changed)
+    EXECUTE FUNCTION notify_users_auth_changed()
+    """,
+]
+
+
+# Unread counts per (receiver, sender), kept up to date by trigger in the same
+# transaction as the message change. The counters are backfilled once, when the
+# table is first created, under a SHARE lock that holds message writes back: this
+# only runs from python -m app.install_schema, never at worker startup.
+UNREAD_COUNTERS_DDL = [
+    """
+    DO $$
+    BEGIN
+        IF to_regclass('unread_counters') IS NULL THEN
+            CREATE TABLE unread_counters (
+                receiver_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+                sender_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+                unread_count integer NOT NULL DEFAULT 0,
+                PRIMARY KEY (receiver_id, sender_id)
+            );
+            LOCK TABLE private_messages IN SHARE MODE;
+            INSERT INTO unread_counters (receiver_id, sender_id, unread_count)
+            SELECT receiver_id, sender_id, count(*) FROM private_messages
+            WHERE is_read GROUP BY receiver_id, sender_id;
+        END IF;
+    END;
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION maintain_unread_counters() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.is_read THEN
+            UPDATE unread_counters SET unread_count = unread_count - 1
+            WHERE receiver_id = OLD.receiver_id AND sender_id = OLD.sender_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.is_read THEN
+            INSERT INTO unread_counters (receiver_id, sender_id, unread_count)
+            VALUES (NEW.receiver_id, NEW.sender_id, 1)
+            ON CONFLICT (receiver_id, sender_id)
+            DO UPDATE SET unread_count = unread_counters.unread_count + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS private_messages_unread_counters ON private_messages",
+    """
+    CREATE TRIGGER private_messages_unread_counters
+    AFTER INSERT OR DELETE OR UPDATE OF is_read, receiver_id, sender_id ON private_messages
+    FOR EACH ROW EXECUTE FUNCTION maintain_unread_counters()
+    """,
+]
+
+
+# Indexes behind the scheduler's batched lookups, built CONCURRENTLY so writes go on
+INDEXES_DDL = {
+    "ix_private_messages_unread": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_private_messages_unread
+    ON private_messages (receiver_id, id) INCLUDE (sender_id, "fileUrl") WHERE is_read
+    """,
+    "ix_room_invitations_pending": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_room_invitations_pending
+    ON room_invitations (recipient_id) WHERE status = 'pending'
+    """,
+}
+
+
+async def missing_triggers(connection):
+    rows = await connection.fetch(
+        "SELECT tgname FROM pg_trigger WHERE NOT tgisinternal AND tgname = ANY($1::text[])", TRIGGER_NAMES
+    )
+    return set(TRIGGER_NAMES) - {row["tgname"] for row in rows}
+
+
+async def install_triggers(connection, replace: bool = True):
+    """
+    Create (or replace) the NOTIFY triggers the notification listener relies on.
+
+    Args:
+        connection (asyncpg.Connection): A raw asyncpg connection.
+        replace (bool): If False, nothing is done when every trigger already exists,
+            which is what worker startup uses. ``python -m app.install_schema``
+            replaces them all.
+
+    Returns:
+        None
+    """
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", TRIGGERS_LOCK_ID)
+        if not replace and not await missing_triggers(connection):
+            logger.info("Notification triggers already installed")
+            return
+        for statement in TRIGGERS_DDL:
+            await connection.execute(statement)
+    logger.info("Notification triggers installed")
+
+
+async def install_unread_counters(connection):
+    """
+    Create and backfill the unread_counters table and its trigger. Message writes
+    wait while the table is backfilled, run it as an offline step.
+
+    Args:
+        connection (asyncpg.Connection): A raw asyncpg connection.
+
+    Returns:
+        None
+    """
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", TRIGGERS_LOCK_ID)
+        for statement in UNREAD_COUNTERS_DDL:
+            await connection.execute(statement)
+    logger.info("Unread counters installed")
+
+
+async def install_indexes(connection, indexes: Dict[str, str] = INDEXES_DDL):
+    """
+    Build the indexes with CREATE INDEX CONCURRENTLY, outside a transaction. An
+    index left invalid by an interrupted build is dropped and built again.
+
+    Args:
+        connection (asyncpg.Connection): A raw asyncpg connection, not in a transaction.
+        indexes (Dict[str, str]): The CREATE INDEX statement per index name.
+
+    Returns:
+        None
+    """
+    for name, statement in indexes.items():
+        invalid = await connection.fetchval(
+            "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name
+        )
+        if invalid:
+            await connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        await connection.execute(statement)
+    logger.info(f"Indexes installed: {', '.join(indexes)}")
@@ -1,10 +1,100 @@
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from passlib.context import CryptContext
+from .config import settings
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt takes 100-300 ms of CPU and releases the GIL, so it runs in a small pool.
+# The semaphore bounds how many hashes are queued at once, the rest of the
+# logins wait on the event loop without holding a thread.
+hash_executor = ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix="bcrypt")
+hash_semaphore = asyncio.Semaphore(settings.password_hash_concurrency)
+
 
 def hash(password: str):
     return pwd_context.hash(password)
 
 
 def verify(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+async def async_hash(password: str):
+    async with hash_semaphore:
+        return await asyncio.get_running_loop().run_in_executor(hash_executor, hash, password)
+
+
+async def async_verify(plain_password, hashed_password):
+    """
+    verify() off the event loop, so a login doesn't stall every socket of the worker.
+    """
+    async with hash_semaphore:
+        return await asyncio.get_running_loop().run_in_executor(hash_executor, verify, plain_password, hashed_password)
+
+
+class TTLCache:
+    """
+    Small LRU cache whose entries also expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class RateLimiter:
+    """
+    One token bucket per key: ``rate`` tokens a second, up to ``burst``. At most
+    ``maxsize`` keys are tracked, the least recently used bucket is forgotten
+    first. A ``rate`` of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def allow(self, key, cost: float = 1.0) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return allowed
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+import statistics
+import sys
+from typing import Dict, List
+
+
+def configure_env():
+    """
+    Fill in the settings app.config requires, so the benchmarks run without a
+    .env file. Values already set in the environment win.
+    """
+    from cryptography.fernet import Fernet
+
+    defaults = {
+        "DATABASE_HOSTNAME": "localhost",
+        "DATABASE_HOSTNAME_COMPANY": "localhost",
+        "DATABASE_PORT": "5432",
+        "DATABASE_PASSWORD": "postgres",
+        "DATABASE_PASSWORD_COMPANY": "postgres",
+        "DATABASE_NAME": "postgres",
+        "DATABASE_USERNAME": "postgres",
+        "SECRET_KEY": "benchmark-secret",
+        "ALGORITHM": "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": "60",
+        "KEY_CRYPTO": Fernet.generate_key().decode(),
+        "OPENAI_API_KEY": "",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": values[-1],
+    }
+
+
+class LoopLagProbe:
+    """
+    Measures event-loop lag: how late a ``sleep(interval)`` wakes up.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return percentiles(self.samples)
+
+
+def report(result: dict, output: str = None):
+    """
+    Write the result as JSON, to ``output`` or stdout, so runs can be compared.
+    """
+    text = json.dumps(result, indent=2, default=str)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
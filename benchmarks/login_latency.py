@@ -0,0 +1,99 @@
+"""
+Event-loop latency under concurrent logins.
+
+Drives POST /login through the real route with the database session replaced by
+a stub that returns one user, and measures how late the event loop runs while
+the logins are in flight, once with bcrypt run inline (the old behaviour) and
+once through utils.async_verify.
+
+    python -m benchmarks.login_latency --logins 64 --concurrency 16 [--output run.json]
+"""
+import argparse
+import asyncio
+import time
+
+from .common import LoopLagProbe, configure_env, percentiles, report
+
+configure_env()
+
+import httpx  # noqa: E402
+
+from app import database, utils  # noqa: E402
+from app.main import app  # noqa: E402
+
+PASSWORD = "benchmark-password"
+
+
+class StubUser:
+    id = 1
+    email = "bench@example.com"
+    password = utils.hash(PASSWORD)
+
+
+class StubResult:
+    def scalar_one_or_none(self):
+        return StubUser
+
+
+class StubSession:
+    async def execute(self, query):
+        return StubResult()
+
+
+async def stub_session():
+    yield StubSession()
+
+
+async def inline_verify(plain_password, hashed_password):
+    return utils.verify(plain_password, hashed_password)
+
+
+async def run(mode: str, logins: int, concurrency: int):
+    async_verify = utils.async_verify
+    if mode == "inline":
+        utils.async_verify = inline_verify
+    app.dependency_overrides[database.get_async_session] = stub_session
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        async def login():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/login", data={"username": StubUser.email, "password": PASSWORD})
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        probe = LoopLagProbe()
+        probe.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+        loop_lag = await probe.stop()
+
+    utils.async_verify = async_verify
+    app.dependency_overrides.clear()
+    return {
+        "mode": mode,
+        "logins": logins,
+        "concurrency": concurrency,
+        "statuses": statuses,
+        "logins_per_second": logins / elapsed,
+        "login_latency_seconds": percentiles(latencies),
+        "loop_lag_seconds": loop_lag,
+    }
+
+
+async def main(args):
+    results = [await run(mode, args.logins, args.concurrency) for mode in args.modes]
+    report({"benchmark": "login_latency", "runs": results}, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--modes", nargs="+", choices=["inline", "executor"], default=["inline", "executor"])
+    parser.add_argument("--output")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,411 @@
+"""
+Load test for the /notification WebSocket endpoint.
+
+Starts the FastAPI app in-process under uvicorn, opens N authenticated clients
+against web_private_notification, injects message, invitation, room and
+password-change events, and reports connect rate, delivery latency percentiles,
+database load, memory per connection and event-loop lag as JSON.
+
+Two backends:
+
+* ``standin`` (default): no database. The queries the notification path runs are
+  answered from an in-memory store (and counted), and events are injected through
+  NotificationListener._on_notification exactly as a NOTIFY would arrive.
+* ``postgres``: the app runs its normal lifespan against the database configured
+  in .env / the environment, and events are injected with real INSERT/UPDATE
+  statements that fire the NOTIFY triggers. It writes to private_messages,
+  room_invitations, rooms and users, so only point it at a disposable database.
+
+    python -m benchmarks.notification_load --clients 1000 --rounds 20 [--output run.json]
+
+Clients run in the same process as the server, so memory and loop lag include
+the client side too; compare runs made with the same options.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import msgpack
+
+from .common import LoopLagProbe, configure_env, percentiles, report
+
+# Every client connects from 127.0.0.1, the per-IP connect limit would turn most away
+os.environ.setdefault("NOTIFICATION_CONNECT_RATE_IP", "0")
+configure_env()
+
+# Frame keys that answer each kind of injected event
+EVENT_FRAMES = {
+    "messages": ("new_message", "new_message_delta", "unread_summary"),
+    "invitations": ("new_invitations",),
+    "rooms": ("update",),
+    "password": ("logout",),
+}
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class StandInStore:
+    """
+    In-memory replacement for the queries of the notification path.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.message_ids = itertools.count(1)
+        self.invitation_ids = itertools.count(1)
+        self.messages: Dict[int, Dict[int, dict]] = {}
+        self.invitations: Dict[int, List[dict]] = {}
+        self.password_changed: Dict[int, Optional[datetime]] = {}
+        self.rooms_version = 0
+
+    def install(self):
+        from app import oauth2, presence, rooms_state
+        from app.routers import notification
+
+        store = self
+
+        async def get_current_user(token, session):
+            store.queries += 1
+            token_data = oauth2.verify_access_token(token, Exception("invalid token"))
+            return oauth2.AuthUser(token_data.id, False, None)
+
+        async def get_unread_message_ids_for_users(session, user_ids):
+            store.queries += 1
+            return {user_id: set(store.messages.get(user_id, ())) for user_id in user_ids}
+
+        async def check_new_messages_for_users(session, message_ids):
+            store.queries += 1
+            return {
+                user_id: [msg for message_id, msg in sorted(store.messages.get(user_id, {}).items()) if message_id in ids]
+                for user_id, ids in message_ids.items()
+            }
+
+        async def get_unread_counts_for_users(session, user_ids):
+            store.queries += 1
+            return {
+                user_id: [{"sender_id": 0, "sender": "bench", "count": len(store.messages.get(user_id, ()))}]
+                for user_id in user_ids
+            }
+
+        async def get_pending_invitations_for_users(session, user_ids):
+            store.queries += 1
+            return {user_id: list(store.invitations.get(user_id, ())) for user_id in user_ids}
+
+        async def check_users_password(session, user_ids, clear):
+            store.queries += 1
+            values = {user_id: store.password_changed.get(user_id) for user_id in user_ids}
+            if clear:
+                for user_id in user_ids:
+                    store.password_changed[user_id] = None
+            return values
+
+        async def get_rooms_digest(session):
+            store.queries += 1
+            return str(store.rooms_version)
+
+        async def write(session, rows):
+            store.queries += 1
+
+        async def start_sessions(session, starts):
+            store.queries += 1
+            return {user_id: user_id for user_id in starts}
+
+        oauth2.get_current_user = get_current_user
+        notification.get_unread_message_ids_for_users = get_unread_message_ids_for_users
+        notification.check_new_messages_for_users = check_new_messages_for_users
+        notification.get_unread_counts_for_users = get_unread_counts_for_users
+        notification.get_pending_invitations_for_users = get_pending_invitations_for_users
+        notification.check_users_password = check_users_password
+        rooms_state.get_rooms_digest = get_rooms_digest
+        presence.update_users_status = write
+        presence.users_online_start = start_sessions
+        presence.users_online_end = write
+        presence.touch_online_sessions = write
+
+    async def start(self, app):
+        from app.routers import notification
+
+        self.install()
+        await notification.manager.broker.start()
+        await notification.rooms_state.start()
+        await notification.scheduler.start()
+        await notification.presence.start()
+        await notification.presence_index.start()
+
+    async def stop(self, app):
+        from app.routers import notification
+
+        await notification.presence_index.stop()
+        await notification.presence.stop()
+        await notification.scheduler.stop()
+        await notification.rooms_state.stop()
+        await notification.manager.broker.stop()
+
+    async def db_counter(self) -> int:
+        return self.queries
+
+    async def inject(self, kind: str, user_ids: List[int]):
+        from app.routers.notification import listener
+        from app.triggers import INVITATIONS_CHANNEL, MESSAGES_CHANNEL, PASSWORD_CHANNEL, ROOMS_CHANNEL
+
+        if kind == "rooms":
+            self.rooms_version += 1
+            listener._on_notification(None, 0, ROOMS_CHANNEL, "")
+            return
+        for user_id in user_ids:
+            if kind == "messages":
+                message_id = next(self.message_ids)
+                self.messages.setdefault(user_id, {})[message_id] = {
+                    "sender_id": 0, "sender": "bench", "message_id": message_id,
+                    "message": "Message encoded", "fileUrl": None,
+                }
+                listener._on_notification(None, 0, MESSAGES_CHANNEL, str(user_id))
+            elif kind == "invitations":
+                self.invitations.setdefault(user_id, []).append(
+                    {"room": "bench", "sender": "bench", "invitation_id": next(self.invitation_ids)}
+                )
+                listener._on_notification(None, 0, INVITATIONS_CHANNEL, str(user_id))
+            elif kind == "password":
+                self.password_changed[user_id] = datetime.now(timezone.utc)
+                listener._on_notification(None, 0, PASSWORD_CHANNEL, str(user_id))
+
+
+class PostgresBackend:
+    """
+    The real app against a real database. Events are real writes.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.connection = None
+        self._lifespan = None
+
+    async def start(self, app):
+        import asyncpg
+        from app.database import DATABASE_URL
+
+        self._lifespan = app.router.lifespan_context(app)
+        await self._lifespan.__aenter__()
+        self.connection = await asyncpg.connect(DATABASE_URL)
+
+    async def stop(self, app):
+        await self.connection.close()
+        await self._lifespan.__aexit__(None, None, None)
+
+    async def db_counter(self) -> int:
+        # Transactions, as pg_stat_statements may not be installed
+        return await self.connection.fetchval(
+            "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()"
+        )
+
+    async def inject(self, kind: str, user_ids: List[int]):
+        args = self.args
+        if kind == "messages":
+            await self.connection.execute(
+                "INSERT INTO private_messages (sender_id, receiver_id, message, is_read) "
+                "SELECT $1, user_id, 'bench', true FROM unnest($2::int[]) AS user_id",
+                args.sender_id, user_ids,
+            )
+        elif kind == "invitations":
+            await self.connection.execute(
+                "INSERT INTO room_invitations (room_id, sender_id, recipient_id, status) "
+                "SELECT $1, $2, user_id, 'pending' FROM unnest($3::int[]) AS user_id",
+                args.room_id, args.sender_id, user_ids,
+            )
+        elif kind == "rooms":
+            await self.connection.execute("UPDATE rooms SET secret_room = NOT secret_room WHERE id = $1", args.room_id)
+        elif kind == "password":
+            await self.connection.execute("UPDATE users SET password_changed = now() WHERE id = ANY($1::int[])", user_ids)
+
+
+def decode(payload):
+    """
+    Text frames are JSON, binary ones MessagePack, or either compressed with zlib
+    (a zlib stream starts with 0x78, a MessagePack map never does).
+    """
+    if isinstance(payload, str):
+        return json.loads(payload)
+    if payload[:1] == b"\x78":
+        payload = zlib.decompress(payload)
+        if payload[:1] in (b"{", b"["):
+            return json.loads(payload)
+    return msgpack.unpackb(payload)
+
+
+class Client:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.websocket = None
+        self.pending: Dict[str, float] = {}
+        self.latencies: Dict[str, List[float]] = {kind: [] for kind in EVENT_FRAMES}
+        self.frames = 0
+        self._task = None
+
+    async def connect(self, url: str):
+        import websockets
+
+        self.websocket = await websockets.connect(url, max_size=None, open_timeout=60)
+        self._task = asyncio.create_task(self._read())
+
+    def expect(self, kind: str, sent_at: float):
+        self.pending.setdefault(kind, sent_at)
+
+    async def _read(self):
+        try:
+            async for text in self.websocket:
+                received_at = time.perf_counter()
+                self.frames += 1
+                frame = decode(text)
+                for kind, keys in EVENT_FRAMES.items():
+                    if kind in self.pending and any(key in frame for key in keys):
+                        self.latencies[kind].append(received_at - self.pending.pop(kind))
+        except Exception:
+            pass
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self._task is not None:
+            await self._task
+
+
+async def serve(app, port: int):
+    import uvicorn
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, lifespan="off", log_level="warning",
+                            ws="websockets", ws_max_size=16 * 1024 * 1024, backlog=4096)
+    server = uvicorn.Server(config)
+    server.install_signal_handlers = lambda: None
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def main(args):
+    if args.backend == "standin":
+        os.environ["NOTIFICATION_BROKER"] = "memory"
+        os.environ["NOTIFICATION_INSTALL_TRIGGERS"] = "false"
+
+    from app import oauth2
+    from app.main import app
+    from app.routers.notification import manager
+
+    backend = StandInStore() if args.backend == "standin" else PostgresBackend(args)
+    await backend.start(app)
+    server, server_task = await serve(app, args.port)
+
+    probe = LoopLagProbe()
+    probe.start()
+    user_ids = list(range(args.first_user_id, args.first_user_id + args.clients))
+    clients = [Client(user_id) for user_id in user_ids]
+    query = "&delta=true" if args.delta else ""
+    query += f"&encoding={args.encoding}"
+    if args.compress:
+        query += "&compress=true"
+
+    rss_before = rss_bytes()
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    connect_failures = 0
+
+    async def connect(client):
+        nonlocal connect_failures
+        token = oauth2.create_access_token(data={"user_id": client.user_id})
+        async with semaphore:
+            try:
+                await client.connect(f"ws://127.0.0.1:{args.port}/notification?token={token}{query}")
+            except Exception:
+                connect_failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_seconds = time.perf_counter() - started
+    # Let registration queries and the first frames settle
+    await asyncio.sleep(args.settle)
+    rss_after = rss_bytes()
+    connected = args.clients - connect_failures
+
+    db_before = await backend.db_counter()
+    events_started = time.perf_counter()
+    kinds = itertools.cycle(args.events)
+    rng = random.Random(args.seed)
+    for _ in range(args.rounds):
+        kind = next(kinds)
+        targets = clients if kind == "rooms" else rng.sample(clients, min(args.targets, len(clients)))
+        sent_at = time.perf_counter()
+        for client in targets:
+            client.expect(kind, sent_at)
+        await backend.inject(kind, [client.user_id for client in targets])
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(args.settle)
+    events_seconds = time.perf_counter() - events_started
+    db_after = await backend.db_counter()
+
+    loop_lag = await probe.stop()
+    undelivered = sum(len(client.pending) for client in clients)
+    latencies = {
+        kind: percentiles([latency for client in clients for latency in client.latencies[kind]])
+        for kind in args.events
+    }
+    total_depth, max_depth = manager.queue_depths()
+
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    server.should_exit = True
+    await server_task
+    await backend.stop(app)
+
+    report({
+        "benchmark": "notification_load",
+        "backend": args.backend,
+        "options": vars(args),
+        "clients": {"requested": args.clients, "connected": connected, "failed": connect_failures},
+        "connect_seconds": connect_seconds,
+        "connects_per_second": connected / connect_seconds if connect_seconds else None,
+        "delivery_latency_seconds": latencies,
+        "undelivered_events": undelivered,
+        "frames_received": sum(client.frames for client in clients),
+        "db_operations": db_after - db_before,
+        "db_operations_per_second": (db_after - db_before) / events_seconds,
+        "db_operations_unit": "queries" if args.backend == "standin" else "transactions",
+        "memory_per_connection_bytes": (rss_after - rss_before) / connected if connected else None,
+        "outbox": {
+            "queued_total": total_depth,
+            "queued_max": max_depth,
+            "coalesced": manager.frames_coalesced,
+            "dropped": manager.frames_dropped,
+            "evicted": manager.slow_consumers_evicted,
+        },
+        "loop_lag_seconds": loop_lag,
+    }, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["standin", "postgres"], default="standin")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--first-user-id", type=int, default=1)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--targets", type=int, default=50, help="users hit by each message/invitation/password event")
+    parser.add_argument("--interval", type=float, default=0.25, help="seconds between events")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait after connecting and after the last event")
+    parser.add_argument("--events", nargs="+", choices=list(EVENT_FRAMES), default=list(EVENT_FRAMES))
+    parser.add_argument("--delta", action="store_true", help="connect with ?delta=true")
+    parser.add_argument("--encoding", choices=["json", "msgpack"], default="json", help="wire encoding clients negotiate")
+    parser.add_argument("--compress", action="store_true", help="connect with ?compress=true")
+    parser.add_argument("--sender-id", type=int, default=1, help="postgres backend: sender of injected messages/invitations")
+    parser.add_argument("--room-id", type=int, default=1, help="postgres backend: room used for invitations and room updates")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,147 @@
+import pytest
+
+from benchmarks.common import configure_env
+
+# app.config refuses to load without its settings, none of the units under test use them
+configure_env()
+
+
+class Clock:
+    """
+    Stands in for time.monotonic, moved forward by hand.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    from app import connection_manager, event_log, utils
+
+    clock = Clock()
+    for module in (connection_manager, event_log, utils):
+        monkeypatch.setattr(module.time, "monotonic", clock)
+    return clock
+
+
+class FakeSocket:
+    """
+    Just enough of a WebSocket for ConnectionManagerNotification.
+    """
+
+    def __init__(self):
+        from starlette.websockets import WebSocketState
+
+        self.client_state = WebSocketState.CONNECTED
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        from starlette.websockets import WebSocketState
+
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+class FakeStore:
+    """
+    In-memory stand-in for the batched queries of the notification scheduler,
+    recording what each one was asked for.
+    """
+
+    def __init__(self):
+        self.unread = {}
+        self.invitations = {}
+        self.passwords = {}
+        self.calls = []
+
+    def add_message(self, user_id: int, message_id: int):
+        self.unread.setdefault(user_id, {})[message_id] = {
+            "sender_id": 1, "sender": "sender", "message_id": message_id, "message": "hi", "fileUrl": None,
+        }
+
+    async def get_unread_message_ids_for_users(self, session, user_ids):
+        self.calls.append(("unread_ids", sorted(user_ids)))
+        return {user_id: set(self.unread.get(user_id, {})) for user_id in user_ids}
+
+    async def check_new_messages_for_users(self, session, message_ids):
+        self.calls.append(("messages", {user_id: sorted(ids) for user_id, ids in message_ids.items()}))
+        return {
+            user_id: [self.unread[user_id][message_id] for message_id in sorted(ids)]
+            for user_id, ids in message_ids.items()
+        }
+
+    async def get_pending_invitations_for_users(self, session, user_ids):
+        self.calls.append(("invitations", sorted(user_ids)))
+        return {user_id: list(self.invitations.get(user_id, [])) for user_id in user_ids}
+
+    async def check_users_password(self, session, user_ids, clear):
+        self.calls.append(("password", sorted(user_ids)))
+        return {user_id: self.passwords.get(user_id) for user_id in user_ids}
+
+    async def get_unread_counts_for_users(self, session, user_ids):
+        self.calls.append(("counts", sorted(user_ids)))
+        return {user_id: {"1": len(self.unread.get(user_id, {}))} for user_id in user_ids}
+
+
+class SchedulerHarness:
+    """
+    A NotificationScheduler over an in-memory broker and a FakeStore. Frames stay
+    in the sockets' outboxes, where ``sent`` reads them.
+    """
+
+    def __init__(self):
+        from app.broker import InMemoryBroker
+        from app.connection_manager import ConnectionManagerNotification
+        from app.routers.notification import NotificationScheduler
+
+        self.store = FakeStore()
+        self.rooms_state = type("RoomsState", (), {"version": 0})()
+        self.manager = ConnectionManagerNotification(InMemoryBroker())
+        self.scheduler = NotificationScheduler(self.manager, self.rooms_state)
+
+    async def connect(self, user_id: int, delta: bool = True, since=None, password_changed=None, summary=False):
+        websocket = FakeSocket()
+        await self.manager.connect(websocket, user_id)
+        await self.scheduler.register(websocket, user_id, delta, password_changed, summary=summary, since=since)
+        return websocket
+
+    async def disconnect(self, websocket, user_id: int):
+        await self.manager.disconnect(websocket, user_id)
+        self.scheduler.unregister(websocket, user_id)
+
+    async def tick(self):
+        """
+        Runs the scheduler once over the changes flagged so far.
+        """
+        changes, self.manager.pending_changes = self.manager.pending_changes, {}
+        broadcasts, self.manager.pending_broadcasts = self.manager.pending_broadcasts, set()
+        self.manager.changes_event.clear()
+        await self.scheduler.process(changes, broadcasts)
+
+    def sent(self, websocket):
+        """
+        The data of the frames queued for a socket, which are taken off its outbox.
+        """
+        outbox = self.manager.outboxes[websocket]
+        frames = [frame.data for _, frame in outbox.frames.values()]
+        outbox.frames.clear()
+        return frames
+
+
+@pytest.fixture
+def harness(monkeypatch):
+    from app.routers import notification
+
+    harness = SchedulerHarness()
+    for name in ("get_unread_message_ids_for_users", "check_new_messages_for_users",
+                 "get_pending_invitations_for_users", "check_users_password", "get_unread_counts_for_users"):
+        monkeypatch.setattr(notification, name, getattr(harness.store, name))
+    return harness
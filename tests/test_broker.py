@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+from app.broker import InMemoryBroker, PostgresBroker
+
+
+class OneAtATimeConnection:
+    """
+    Fails like asyncpg when a second operation starts before the first ended.
+    """
+
+    def __init__(self):
+        self.busy = False
+        self.payloads = []
+
+    def is_closed(self):
+        return False
+
+    async def execute(self, query, channel, payload):
+        if self.busy:
+            raise RuntimeError("another operation is in progress")
+        self.busy = True
+        await asyncio.sleep(0.01)
+        self.payloads.append(json.loads(payload))
+        self.busy = False
+
+
+def test_in_memory_broker_delivers_to_every_handler():
+    broker = InMemoryBroker()
+    received = []
+    broker.subscribe(received.append)
+    broker.subscribe(lambda event: 1 / 0)
+    broker.subscribe(received.append)
+    asyncio.run(broker.publish({"user_id": 1}))
+    assert received == [{"user_id": 1}, {"user_id": 1}]
+
+
+def test_concurrent_publishes_take_turns():
+    async def scenario():
+        broker = PostgresBroker(dsn="postgresql://unused")
+        broker.connection = OneAtATimeConnection()
+        local = []
+        broker.subscribe(local.append)
+        await asyncio.gather(*(broker.publish({"n": n}) for n in range(5)))
+        # Every event went out through NOTIFY, none fell back to local delivery
+        assert sorted(event["n"] for event in broker.connection.payloads) == list(range(5))
+        assert local == []
+
+    asyncio.run(scenario())
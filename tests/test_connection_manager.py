@@ -0,0 +1,147 @@
+import asyncio
+import json
+import zlib
+from datetime import datetime, timezone
+
+import msgpack
+
+from app.connection_manager import Outbox, make_frame, merge_frames
+from app.schemas import InvitationSchema
+
+
+def delta(added=(), read=(), seq=None):
+    data = {"new_message_delta": {"added": [{"message_id": i} for i in added], "read": list(read)}}
+    if seq is not None:
+        data["seq"] = seq
+    return make_frame(data, "messages")
+
+
+def test_frame_encodes_once_per_encoding():
+    frame = make_frame({"heartbeat": True})
+    assert json.loads(frame.text) == {"heartbeat": True}
+    assert msgpack.unpackb(frame.packed) == {"heartbeat": True}
+    assert frame.text is frame.text
+    assert frame.packed is frame.packed
+    assert frame.size(False) == len(frame.text)
+    assert frame.size(True) == len(frame.packed)
+
+
+def test_frame_encodes_models_and_datetimes():
+    invitation = InvitationSchema(id=1, room_id=2, sender_id=3, status="pending",
+                                  created_at=datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc))
+    frame = make_frame({"new_invitations": [invitation]})
+    expected = {"new_invitations": [{"id": 1, "room_id": 2, "sender_id": 3, "status": "pending",
+                                     "created_at": "2024-01-02T03:04:05Z"}]}
+    assert json.loads(frame.text) == expected
+    assert msgpack.unpackb(frame.packed) == expected
+
+
+def test_merge_frames_combines_deltas():
+    merged = merge_frames(delta(added=[1, 2], seq=1), delta(added=[3], read=[4], seq=2))
+    assert merged.key == "messages"
+    assert merged.data == {
+        "new_message_delta": {"added": [{"message_id": 1}, {"message_id": 2}, {"message_id": 3}], "read": [4]},
+        "seq": 2,
+    }
+
+
+def test_merge_frames_drops_messages_read_since():
+    merged = merge_frames(delta(added=[1, 2]), delta(read=[1]))
+    assert merged.data["new_message_delta"] == {"added": [{"message_id": 2}], "read": [1]}
+
+
+def test_merge_frames_replaces_full_state():
+    new = make_frame({"invitations": [2]}, "invitations")
+    assert merge_frames(make_frame({"invitations": [1]}, "invitations"), new) is new
+    full = make_frame({"new_message": []}, "messages")
+    assert merge_frames(delta(added=[1]), full) is full
+
+
+def test_outbox_coalesces_keyed_frames_in_place(clock):
+    outbox = Outbox(maxsize=10, max_lag=0)
+    assert outbox.put(make_frame({"rooms": 1}, "rooms")) == "queued"
+    assert outbox.put(make_frame({"a": 1})) == "queued"
+    assert outbox.put(make_frame({"rooms": 2}, "rooms")) == "coalesced"
+    assert len(outbox) == 2
+
+    async def drain():
+        return [(await outbox.get()).data for _ in range(2)]
+
+    assert asyncio.run(drain()) == [{"rooms": 2}, {"a": 1}]
+
+
+def test_outbox_merges_deltas(clock):
+    outbox = Outbox(maxsize=10, max_lag=0)
+    outbox.put(delta(added=[1]))
+    assert outbox.put(delta(added=[2])) == "coalesced"
+    frame = asyncio.run(outbox.get())
+    assert [msg["message_id"] for msg in frame.data["new_message_delta"]["added"]] == [1, 2]
+
+
+def test_outbox_evicted_when_full(clock):
+    outbox = Outbox(maxsize=2, max_lag=0)
+    assert outbox.put(make_frame({"n": 1})) == "queued"
+    assert outbox.put(make_frame({"n": 2})) == "queued"
+    assert outbox.put(make_frame({"n": 3})) == "dropped"
+    assert outbox.evicted.is_set()
+    assert outbox.put(make_frame({"n": 4}, "rooms")) == "dropped"
+
+
+def test_outbox_full_still_coalesces(clock):
+    outbox = Outbox(maxsize=1, max_lag=0)
+    outbox.put(make_frame({"rooms": 1}, "rooms"))
+    assert outbox.put(make_frame({"rooms": 2}, "rooms")) == "coalesced"
+    assert not outbox.evicted.is_set()
+
+
+def test_outbox_evicted_when_lagging(clock):
+    outbox = Outbox(maxsize=10, max_lag=30)
+    outbox.put(make_frame({"n": 1}))
+    clock.advance(30)
+    assert outbox.put(make_frame({"n": 2})) == "queued"
+    clock.advance(0.1)
+    assert outbox.put(make_frame({"n": 3})) == "dropped"
+    assert outbox.evicted.is_set()
+
+
+def test_outbox_lag_counts_from_oldest_queued(clock):
+    outbox = Outbox(maxsize=10, max_lag=30)
+    outbox.put(make_frame({"n": 1}))
+    clock.advance(20)
+    asyncio.run(outbox.get())
+    outbox.put(make_frame({"n": 2}))
+    clock.advance(20)
+    assert outbox.put(make_frame({"n": 3})) == "queued"
+
+
+def test_frame_deflates_each_encoding():
+    frame = make_frame({"new_message": ["x" * 100] * 20})
+    assert zlib.decompress(frame.deflated(True)) == frame.packed
+    assert zlib.decompress(frame.deflated(False)).decode() == frame.text
+    assert len(frame.deflated(False)) < frame.size(False)
+    # A zlib stream starts with 0x78, which no MessagePack map does
+    assert frame.deflated(True)[0] == 0x78 and frame.packed[0] != 0x78
+
+
+def test_merge_frames_keeps_every_added_message():
+    merged = merge_frames(delta(added=range(500)), delta(added=range(500, 1000)))
+    assert len(merged.data["new_message_delta"]["added"]) == 1000
+
+
+def test_only_queued_frames_count_as_sent(clock):
+    from prometheus_client import REGISTRY
+
+    from app.connection_manager import ConnectionManagerNotification
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    manager = ConnectionManagerNotification()
+    websocket = object()
+    manager.outboxes[websocket] = Outbox(maxsize=10, max_lag=0)
+    sent = sample("notifications_sent_total", type="rooms")
+    coalesced = sample("notification_frames_coalesced_total")
+    manager.send_frame(websocket, make_frame({"rooms": 1}, "rooms"))
+    manager.send_frame(websocket, make_frame({"rooms": 2}, "rooms"))
+    assert sample("notifications_sent_total", type="rooms") - sent == 1
+    assert sample("notification_frames_coalesced_total") - coalesced == 1
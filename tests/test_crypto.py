@@ -0,0 +1,35 @@
+import asyncio
+import base64
+
+from app import crypto
+
+
+def test_round_trip():
+    assert crypto.decrypt(crypto.encrypt("привіт")) == "привіт"
+    assert crypto.encrypt(None) is None
+    assert crypto.decrypt(None) is None
+
+
+def test_encrypted_values_carry_the_prefix():
+    assert crypto.is_encrypted(crypto.encrypt("hello"))
+    assert not crypto.is_encrypted("hello")
+
+
+def test_plain_text_is_returned_as_is():
+    assert crypto.decrypt("hello") == "hello"
+    # Valid base64 that isn't a Fernet token is still plain text
+    plain = base64.b64encode(b"not a token").decode()
+    assert crypto.decrypt(plain) == plain
+
+
+def test_corrupted_token_decrypts_to_none():
+    token = crypto.encrypt("hello")
+    assert crypto.decrypt(token[:-8] + "AAAAAAA=") is None
+    assert crypto.decrypt(crypto.ENCRYPTED_PREFIX + "!!!") is None
+
+
+def test_bulk_calls_keep_order_and_none():
+    values = ["a", None, "b"]
+    encrypted = asyncio.run(crypto.async_encrypt_many(values))
+    assert encrypted[1] is None
+    assert asyncio.run(crypto.async_decrypt_many(encrypted + ["plain"])) == values + ["plain"]
@@ -0,0 +1,87 @@
+from app.event_log import EventLog
+
+
+def messages(ids):
+    return {"new_message_delta": {"added": [{"message_id": i} for i in ids], "read": []}}
+
+
+def test_since_returns_events_after_cursor(clock):
+    log = EventLog(size=10, ttl=60)
+    first = log.append([1], "rooms", {"rooms": 1})
+    second = log.append([1], "invitations", {"invitations": [1]})
+    frames = log.since(1, first)
+    assert [frame.data for frame in frames] == [{"invitations": [1], "seq": second}]
+    assert log.since(1, second) == []
+
+
+def test_sequence_is_shared_across_users(clock):
+    log = EventLog(size=10, ttl=60)
+    a = log.append([1], "rooms", {})
+    b = log.append([2], "rooms", {})
+    assert b > a
+    assert log.cursor(1) == a
+    assert log.cursor(2) == b
+    assert log.cursor(3) == b
+
+
+def test_replacing_keys_keep_the_latest(clock):
+    log = EventLog(size=10, ttl=60)
+    start = log.cursor(1)
+    log.append([1], "invitations", {"invitations": [1]})
+    log.append([1], "invitations", {"invitations": [1, 2]})
+    assert len(log.events[1]) == 1
+    assert [frame.data["invitations"] for frame in log.since(1, start)] == [[1, 2]]
+
+
+def test_deltas_are_merged_on_replay(clock):
+    log = EventLog(size=10, ttl=60)
+    start = log.cursor(1)
+    log.append([1], "messages", messages([1]))
+    last = log.append([1], "messages", messages([2, 3]))
+    [frame] = log.since(1, start)
+    assert frame.data["seq"] == last
+    assert [msg["message_id"] for msg in frame.data["new_message_delta"]["added"]] == [1, 2, 3]
+
+
+def test_cursor_from_another_epoch_needs_resync(clock):
+    log = EventLog(size=10, ttl=60)
+    other = EventLog(size=10, ttl=60)
+    other.epoch = log.epoch + 1
+    seq = other.append([1], "rooms", {})
+    assert log.since(1, seq) is None
+    assert log.since(1, log.last_seq + 1) is None
+    assert log.since(1, 0) is None
+
+
+def test_cursor_older_than_a_full_log_needs_resync(clock):
+    log = EventLog(size=2, ttl=60)
+    start = log.cursor(1)
+    first = log.append([1], "rooms", {})
+    log.append([1], "rooms", {})
+    log.append([1], "rooms", {})
+    assert len(log.events[1]) == 2
+    assert log.since(1, start) is None
+    assert log.since(1, first) is not None
+
+
+def test_compact_drops_expired_events(clock):
+    log = EventLog(size=10, ttl=60)
+    start = log.cursor(1)
+    log.append([1], "rooms", {})
+    clock.advance(30)
+    kept = log.append([2], "rooms", {})
+    clock.advance(31)
+    log.compact()
+    assert 1 not in log.events
+    assert 2 in log.events
+    # user 1's cursor predates what the log still holds
+    assert log.since(1, start) is None
+    assert log.since(2, kept) == []
+
+
+def test_disabled_log_still_numbers_events(clock):
+    log = EventLog(size=0, ttl=60)
+    a = log.append([1], "rooms", {})
+    b = log.append([1], "rooms", {})
+    assert b == a + 1
+    assert not log.events
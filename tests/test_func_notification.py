@@ -0,0 +1,72 @@
+import asyncio
+from collections import namedtuple
+
+import pytest
+
+from app.routers import func_notification
+
+Invitation = namedtuple("Invitation", "id recipient_id name_room user_name")
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+class FakeSession:
+    """
+    Answers every query with the same rows, running ``during`` while it is in flight.
+    """
+
+    def __init__(self, rows, during=None):
+        self.rows = rows
+        self.during = during
+        self.queries = 0
+
+    async def execute(self, query):
+        self.queries += 1
+        if self.during:
+            self.during()
+        return FakeResult(self.rows)
+
+
+@pytest.fixture(autouse=True)
+def empty_invitation_cache():
+    func_notification.invalidate_invitations()
+    yield
+    func_notification.invalidate_invitations()
+
+
+def get_invitations(session, user_ids):
+    return asyncio.run(func_notification.get_pending_invitations_for_users(session, user_ids))
+
+
+def test_invitations_are_cached_per_recipient():
+    session = FakeSession([Invitation(1, 5, "room", "alice")])
+    expected = {5: [{"room": "room", "sender": "alice", "invitation_id": 1}], 6: []}
+    assert get_invitations(session, [5, 6]) == expected
+    assert get_invitations(session, [5, 6]) == expected
+    assert session.queries == 1
+
+
+def test_invalidation_during_the_query_is_not_overwritten():
+    rows = [Invitation(1, 5, "room", "alice")]
+    session = FakeSession(rows, during=lambda: func_notification.invalidate_invitations(5))
+    assert get_invitations(session, [5, 6])[5] == [{"room": "room", "sender": "alice", "invitation_id": 1}]
+    # 5 may have been read before the change: it is fetched again, 6 is cached
+    session.during = None
+    get_invitations(session, [5, 6])
+    assert session.queries == 2
+    get_invitations(session, [5, 6])
+    assert session.queries == 2
+
+
+def test_invalidating_everyone_during_the_query_caches_nothing():
+    session = FakeSession([], during=func_notification.invalidate_invitations)
+    get_invitations(session, [5])
+    session.during = None
+    get_invitations(session, [5])
+    assert session.queries == 2
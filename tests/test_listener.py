@@ -0,0 +1,74 @@
+from app import oauth2
+from app.listener import NotificationListener
+from app.routers import func_notification
+from app.triggers import AUTH_CHANNEL, INVITATIONS_CHANNEL, MESSAGES_CHANNEL, PASSWORD_CHANNEL, ROOMS_CHANNEL
+
+
+class RecordingManager:
+    def __init__(self):
+        self.calls = []
+
+    def notify_user(self, user_id, kind):
+        self.calls.append(("user", user_id, kind))
+
+    def notify_all(self, kind):
+        self.calls.append(("all", kind))
+
+
+class RecordingRoomsState:
+    def __init__(self):
+        self.refreshes = 0
+
+    def schedule_refresh(self):
+        self.refreshes += 1
+
+
+def make_listener():
+    return NotificationListener(RecordingManager(), RecordingRoomsState())
+
+
+def test_user_payload_flags_that_user():
+    listener = make_listener()
+    listener._on_notification(None, 0, MESSAGES_CHANNEL, "42")
+    listener._on_notification(None, 0, PASSWORD_CHANNEL, "7")
+    assert listener.manager.calls == [("user", 42, "messages"), ("user", 7, "password")]
+
+
+def test_empty_payload_flags_everyone():
+    listener = make_listener()
+    listener._on_notification(None, 0, MESSAGES_CHANNEL, "")
+    assert listener.manager.calls == [("all", "messages")]
+
+
+def test_invitations_drop_the_recipients_cache():
+    listener = make_listener()
+    func_notification.invitation_cache.set(5, ["cached"])
+    func_notification.invitation_cache.set(6, ["cached"])
+    listener._on_notification(None, 0, INVITATIONS_CHANNEL, "5")
+    assert func_notification.invitation_cache.get(5) is None
+    assert func_notification.invitation_cache.get(6) == ["cached"]
+    assert listener.manager.calls == [("user", 5, "invitations")]
+
+
+def test_rooms_refresh_the_snapshot_once():
+    listener = make_listener()
+    func_notification.invitation_cache.set(5, ["cached"])
+    listener._on_notification(None, 0, ROOMS_CHANNEL, "")
+    assert listener.rooms_state.refreshes == 1
+    assert func_notification.invitation_cache.get(5) is None
+    assert listener.manager.calls == []
+
+
+def test_auth_only_drops_the_cached_user():
+    listener = make_listener()
+    oauth2.user_cache.set(3, oauth2.AuthUser(3, False, None))
+    listener._on_notification(None, 0, AUTH_CHANNEL, "3")
+    assert oauth2.user_cache.get(3) is None
+    assert listener.manager.calls == []
+
+
+def test_unexpected_payloads_are_ignored():
+    listener = make_listener()
+    listener._on_notification(None, 0, MESSAGES_CHANNEL, "not a user id")
+    listener._on_notification(None, 0, "some_other_channel", "1")
+    assert listener.manager.calls == []
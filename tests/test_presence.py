@@ -0,0 +1,114 @@
+import asyncio
+import contextlib
+import json
+
+import pytest
+
+from app import presence
+from app.broker import NOTIFY_PAYLOAD_LIMIT
+from app.config import settings
+
+
+class RecordingWrites:
+    def __init__(self):
+        self.writes = []
+        self.next_session_id = 100
+
+    async def update_users_status(self, session, statuses):
+        self.writes.append(("status", dict(statuses)))
+
+    async def users_online_start(self, session, starts):
+        self.writes.append(("start", sorted(starts)))
+        session_ids = {}
+        for user_id in starts:
+            self.next_session_id += 1
+            session_ids[user_id] = self.next_session_id
+        return session_ids
+
+    async def users_online_end(self, session, ends):
+        self.writes.append(("end", sorted(ends)))
+
+    async def touch_online_sessions(self, session, session_ids):
+        self.writes.append(("touch", sorted(session_ids)))
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    writes = RecordingWrites()
+    for name in ("update_users_status", "users_online_start", "users_online_end", "touch_online_sessions"):
+        monkeypatch.setattr(presence, name, getattr(writes, name))
+
+    @contextlib.asynccontextmanager
+    async def session_maker():
+        yield None
+
+    monkeypatch.setattr(presence, "async_session_maker", session_maker)
+    monkeypatch.setattr(settings, "presence_track_online_time", True)
+    return writes
+
+
+def test_flush_writes_statuses_and_sessions_in_bulk(writes):
+    writer = presence.PresenceWriter()
+    writer.connected(1)
+    writer.connected(2)
+    asyncio.run(writer.flush())
+    assert writes.writes == [("status", {1: True, 2: True}), ("start", [1, 2])]
+    assert writer.session_ids == {1: 101, 2: 102}
+
+
+def test_flap_within_an_interval_writes_no_session(writes):
+    writer = presence.PresenceWriter()
+    writer.connected(1)
+    asyncio.run(writer.flush())
+    writes.writes.clear()
+
+    writer.disconnected(1)
+    writer.connected(1)
+    asyncio.run(writer.flush())
+    # The session that was already written just goes on
+    assert writes.writes == [("status", {1: True})]
+    assert writer.session_ids == {1: 101}
+
+
+def test_short_visit_never_opens_a_session(writes):
+    writer = presence.PresenceWriter()
+    writer.connected(1)
+    writer.disconnected(1)
+    asyncio.run(writer.flush())
+    assert writes.writes == [("status", {1: False})]
+
+
+def test_only_sessions_opened_here_are_closed(writes):
+    writer = presence.PresenceWriter()
+    writer.connected(1)
+    asyncio.run(writer.flush())
+    writes.writes.clear()
+
+    writer.disconnected(1)
+    # Never connected here: the session is another worker's to close
+    writer.disconnected(2)
+    asyncio.run(writer.flush())
+    assert writes.writes == [("status", {1: False, 2: False}), ("end", [101])]
+    assert writer.session_ids == {}
+
+
+def test_touch_marks_open_sessions(writes):
+    writer = presence.PresenceWriter()
+    writer.connected(1)
+    writer.connected(2)
+    asyncio.run(writer.flush())
+    writer.disconnected(2)
+    asyncio.run(writer.flush())
+    writes.writes.clear()
+    asyncio.run(writer.touch())
+    assert writes.writes == [("touch", [101])]
+
+
+def test_presence_chunks_fit_a_notify_payload():
+    user_ids = list(range(10 ** 9, 10 ** 9 + 3000))
+    chunks = presence.chunk_ids(user_ids)
+    assert [user_id for chunk in chunks for user_id in chunk] == user_ids
+    for chunk in chunks:
+        event = {"presence_snapshot": presence.NODE_ID, "first": False, "user_ids": chunk}
+        assert len(json.dumps(event, separators=(",", ":"))) < NOTIFY_PAYLOAD_LIMIT
+    assert presence.chunk_ids([]) == []
@@ -0,0 +1,248 @@
+import asyncio
+
+from app.routers import notification
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def message_ids(frame):
+    return [msg["message_id"] for msg in frame["new_message_delta"]["added"]]
+
+
+def test_resume_gets_only_what_was_missed(harness):
+    async def scenario():
+        harness.store.add_message(7, 1)
+        websocket = await harness.connect(7)
+        await harness.tick()
+        [first] = harness.sent(websocket)
+        await harness.disconnect(websocket, 7)
+
+        harness.store.add_message(7, 2)
+        websocket = await harness.connect(7, since=first["seq"])
+        # Nothing was logged after the cursor yet, the new message comes on the tick
+        assert harness.sent(websocket) == []
+        await harness.tick()
+        [frame] = harness.sent(websocket)
+        assert message_ids(frame) == [2]
+        assert frame["seq"] > first["seq"]
+
+    run(scenario())
+
+
+def test_resume_replays_events_logged_for_other_sockets(harness):
+    async def scenario():
+        harness.store.add_message(7, 1)
+        phone = await harness.connect(7)
+        await harness.tick()
+        [first] = harness.sent(phone)
+        laptop = await harness.connect(7)
+        harness.sent(laptop)
+        await harness.disconnect(phone, 7)
+
+        harness.store.add_message(7, 2)
+        harness.store.add_message(7, 3)
+        harness.manager.notify_user(7, "messages")
+        await harness.tick()
+        harness.sent(laptop)
+
+        phone = await harness.connect(7, since=first["seq"])
+        [frame] = harness.sent(phone)
+        assert message_ids(frame) == [2, 3]
+
+    run(scenario())
+
+
+def test_unknown_cursor_gets_resync_and_full_state(harness):
+    async def scenario():
+        harness.store.add_message(7, 1)
+        websocket = await harness.connect(7, since=12345)
+        assert harness.sent(websocket) == [{"resync": True}]
+        await harness.tick()
+        [frame] = harness.sent(websocket)
+        assert message_ids(frame) == [1]
+
+    run(scenario())
+
+
+def test_full_list_socket_replays_full_list(harness):
+    async def scenario():
+        harness.store.add_message(7, 1)
+        websocket = await harness.connect(7, delta=False)
+        await harness.tick()
+        [first] = harness.sent(websocket)
+        assert [msg["message_id"] for msg in first["new_message"]] == [1]
+        await harness.disconnect(websocket, 7)
+
+        other = await harness.connect(7)
+        harness.store.add_message(7, 2)
+        harness.manager.notify_user(7, "messages")
+        await harness.tick()
+        await harness.disconnect(other, 7)
+
+        websocket = await harness.connect(7, delta=False, since=first["seq"])
+        [frame] = harness.sent(websocket)
+        assert [msg["message_id"] for msg in frame["new_message"]] == [1, 2]
+
+    run(scenario())
+
+
+def test_resume_onto_parked_inbox_checks_password(harness):
+    async def scenario():
+        websocket = await harness.connect(7, password_changed="before")
+        await harness.tick()
+        seq = harness.scheduler.event_log.cursor(7)
+        await harness.disconnect(websocket, 7)
+
+        # The NOTIFY of the change finds no socket of the user
+        harness.store.passwords[7] = "after"
+        harness.manager.notify_user(7, "password")
+        websocket = await harness.connect(7, since=seq)
+        assert 7 in harness.manager.pending_changes["password"]
+        await harness.tick()
+        assert any(frame.get("logout") for frame in harness.sent(websocket))
+
+    run(scenario())
+
+
+def test_resume_replays_room_update(harness):
+    async def scenario():
+        websocket = await harness.connect(7)
+        await harness.tick()
+        seq = harness.scheduler.event_log.cursor(7)
+        await harness.disconnect(websocket, 7)
+
+        harness.rooms_state.version += 1
+        await harness.scheduler.process({}, {"rooms"})
+
+        websocket = await harness.connect(7, since=seq)
+        [frame] = harness.sent(websocket)
+        assert frame["update"] == "room update"
+        assert frame["seq"] == harness.scheduler.rooms_seq
+
+        # A cursor after the update doesn't get it again
+        await harness.disconnect(websocket, 7)
+        websocket = await harness.connect(7, since=frame["seq"])
+        assert harness.sent(websocket) == []
+
+    run(scenario())
+
+
+def test_message_committed_out_of_order_is_sent(harness):
+    async def scenario():
+        harness.store.add_message(7, 101)
+        websocket = await harness.connect(7)
+        await harness.tick()
+        assert message_ids(harness.sent(websocket)[0]) == [101]
+
+        # 100 commits after 101: it is below the highest id already sent
+        harness.store.add_message(7, 100)
+        harness.manager.notify_user(7, "messages")
+        await harness.tick()
+        [frame] = harness.sent(websocket)
+        assert message_ids(frame) == [100]
+        assert harness.store.calls[-1] == ("messages", {7: [100]})
+
+    run(scenario())
+
+
+def test_read_messages_are_sent_as_read(harness):
+    async def scenario():
+        harness.store.add_message(7, 1)
+        harness.store.add_message(7, 2)
+        websocket = await harness.connect(7)
+        await harness.tick()
+        harness.sent(websocket)
+
+        del harness.store.unread[7][1]
+        harness.manager.notify_user(7, "messages")
+        await harness.tick()
+        [frame] = harness.sent(websocket)
+        assert frame["new_message_delta"]["added"] == []
+        assert frame["new_message_delta"]["read"] == [1]
+        assert frame["new_message_delta"]["unread_total"] == 1
+
+    run(scenario())
+
+
+def test_unchanged_inbox_sends_nothing(harness):
+    async def scenario():
+        harness.store.add_message(7, 1)
+        websocket = await harness.connect(7)
+        await harness.tick()
+        harness.sent(websocket)
+
+        harness.manager.notify_user(7, "messages")
+        await harness.tick()
+        assert harness.sent(websocket) == []
+        # Only the ids were read, no message was fetched again
+        assert harness.store.calls[-1][0] != "messages"
+
+    run(scenario())
+
+
+def test_one_query_per_kind_for_every_user_of_a_tick(harness):
+    async def scenario():
+        sockets = {}
+        for user_id in (1, 2, 3):
+            harness.store.add_message(user_id, user_id * 10)
+            sockets[user_id] = await harness.connect(user_id)
+        await harness.tick()
+        assert harness.store.calls == [
+            ("unread_ids", [1, 2, 3]),
+            ("messages", {1: [10], 2: [20], 3: [30]}),
+            ("invitations", [1, 2, 3]),
+        ]
+        for user_id, websocket in sockets.items():
+            assert message_ids(harness.sent(websocket)[0]) == [user_id * 10]
+
+    run(scenario())
+
+
+def test_full_lists_are_capped_deltas_are_not(harness, monkeypatch):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "notification_max_unread", 2)
+
+    async def scenario():
+        for message_id in (1, 2, 3):
+            harness.store.add_message(7, message_id)
+        full = await harness.connect(7, delta=False)
+        delta = await harness.connect(7)
+        await harness.tick()
+        [frame] = harness.sent(full)
+        assert [msg["message_id"] for msg in frame["new_message"]] == [1, 2]
+        assert frame["unread_total"] == 3
+        [frame] = harness.sent(delta)
+        assert message_ids(frame) == [1, 2, 3]
+
+    run(scenario())
+
+
+def test_failed_message_fetch_sends_nothing_and_retries(harness, monkeypatch):
+    async def scenario():
+        websocket = await harness.connect(7)
+        await harness.tick()
+        harness.sent(websocket)
+
+        fetch = harness.store.check_new_messages_for_users
+
+        async def failing(session, message_ids):
+            return None
+
+        harness.store.add_message(7, 1)
+        harness.store.add_message(7, 2)
+        monkeypatch.setattr(notification, "check_new_messages_for_users", failing)
+        harness.manager.notify_user(7, "messages")
+        await harness.tick()
+        # No delta with the new rows missing, and the inbox doesn't count them as sent
+        assert harness.sent(websocket) == []
+
+        monkeypatch.setattr(notification, "check_new_messages_for_users", fetch)
+        harness.manager.notify_user(7, "messages")
+        await harness.tick()
+        [frame] = harness.sent(websocket)
+        assert message_ids(frame) == [1, 2]
+
+    run(scenario())
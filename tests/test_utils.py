@@ -0,0 +1,92 @@
+from app.utils import RateLimiter, TTLCache
+
+
+def test_ttl_cache_expires_entries(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    clock.advance(4.9)
+    assert cache.get("a") == 1
+    clock.advance(0.1)
+    assert cache.get("a") is None
+
+
+def test_ttl_cache_ttl_is_capped(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("short", 1, ttl=1)
+    cache.set("long", 2, ttl=60)
+    clock.advance(1)
+    assert cache.get("short") is None
+    clock.advance(3.9)
+    assert cache.get("long") == 2
+    clock.advance(0.1)
+    assert cache.get("long") is None
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = TTLCache(maxsize=2, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_disabled():
+    cache = TTLCache(maxsize=0, ttl=5)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_ttl_cache_pop_and_clear(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.pop("a")
+    cache.pop("missing")
+    assert cache.get("a") is None
+    cache.clear()
+    assert cache.get("b") is None
+
+
+def test_rate_limiter_refills(clock):
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.allow("ip") for _ in range(4)] == [True, True, True, False]
+    clock.advance(0.5)
+    assert limiter.allow("ip")
+    assert not limiter.allow("ip")
+    clock.advance(10)
+    assert [limiter.allow("ip") for _ in range(4)] == [True, True, True, False]
+
+
+def test_rate_limiter_cost(clock):
+    limiter = RateLimiter(rate=1, burst=5)
+    assert limiter.allow("user", cost=5)
+    assert not limiter.allow("user", cost=1)
+    clock.advance(2)
+    assert not limiter.allow("user", cost=3)
+    assert limiter.allow("user", cost=2)
+
+
+def test_rate_limiter_keys_are_independent(clock):
+    limiter = RateLimiter(rate=1, burst=1)
+    assert limiter.allow("a")
+    assert not limiter.allow("a")
+    assert limiter.allow("b")
+
+
+def test_rate_limiter_disabled(clock):
+    limiter = RateLimiter(rate=0, burst=0)
+    assert all(limiter.allow("ip") for _ in range(100))
+
+
+def test_rate_limiter_forgets_least_recently_used(clock):
+    limiter = RateLimiter(rate=1, burst=1, maxsize=2)
+    limiter.allow("a")
+    limiter.allow("b")
+    limiter.allow("a")
+    limiter.allow("c")
+    # "b" was forgotten and starts again with a full bucket, "a" is still empty
+    assert limiter.allow("b")
+    assert not limiter.allow("c")